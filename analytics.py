@@ -0,0 +1,82 @@
+import csv
+import io
+import logging
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from typing import AsyncGenerator, Tuple
+
+from aiogram.types import InputFile
+
+import db
+from background import PeriodicFlusher
+
+logger = logging.getLogger(__name__)
+
+
+def today() -> int:
+    return int(time.time()) // 86400
+
+
+def format_day(day: int) -> str:
+    return datetime.fromtimestamp(day * 86400, tz=timezone.utc).strftime('%d.%m.%Y')
+
+
+# Просмотры товаров и начатые покупки для расчёта конверсии.
+# Копятся в памяти и раз в flush_interval секунд прибавляются к сводке sales_daily.
+class SalesCounters:
+    def __init__(self, flush_interval: float = 5.0):
+        self._views: Counter = Counter()
+        self._checkouts: Counter = Counter()
+        self._flusher = PeriodicFlusher(self.flush, flush_interval, "sales")
+
+    def view(self, product_id: int):
+        self._views[today(), product_id] += 1
+
+    def checkout(self, product_id: int):
+        self._checkouts[today(), product_id] += 1
+
+    async def start(self):
+        self._flusher.start()
+
+    async def stop(self):
+        await self._flusher.stop()
+
+    async def flush(self):
+        if not self._views and not self._checkouts:
+            return
+        views, self._views = self._views, Counter()
+        checkouts, self._checkouts = self._checkouts, Counter()
+        rows = [(day, product_id, views[day, product_id], checkouts[day, product_id])
+                for day, product_id in views.keys() | checkouts.keys()]
+        try:
+            await db.add_sales_activity(rows)
+        except Exception as e:
+            logger.error(f"Не удалось записать просмотры товаров: {e}")
+            self._views.update(views)
+            self._checkouts.update(checkouts)
+
+
+# CSV со сводкой продаж по дням, который отдаётся Telegram по частям, а не собирается целиком
+class SalesCsvFile(InputFile):
+    def __init__(self, filename: str = 'sales.csv', page_size: int = 1000):
+        super().__init__(filename=filename)
+        self.page_size = page_size
+
+    async def read(self, bot) -> AsyncGenerator[bytes, None]:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(['date', 'product_id', 'product', 'views', 'checkouts', 'units', 'revenue'])
+        yield buffer.getvalue().encode('utf-8-sig')
+
+        after: Tuple[int, int] = (-1, -1)
+        while True:
+            rows = await db.get_sales_page(after, self.page_size)
+            if not rows:
+                return
+            buffer.seek(0)
+            buffer.truncate()
+            for day, product_id, name, views, checkouts, units, revenue in rows:
+                writer.writerow([format_day(day), product_id, name or '', views, checkouts, units, revenue])
+            yield buffer.getvalue().encode('utf-8')
+            after = rows[-1][:2]
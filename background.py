@@ -0,0 +1,56 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Coroutine, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# Задачи, запущенные без ожидания. Ссылки держим до завершения, иначе задачу может собрать GC
+_tasks: Set[asyncio.Task] = set()
+
+
+def _done(task: asyncio.Task):
+    _tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Фоновая задача {task.get_name()} завершилась с ошибкой", exc_info=task.exception())
+
+
+# Запуск корутины в фоне: ошибка не потеряется, а попадёт в лог
+def spawn(coro: Coroutine, name: str = None) -> asyncio.Task:
+    task = asyncio.create_task(coro, name=name)
+    _tasks.add(task)
+    task.add_done_callback(_done)
+    return task
+
+
+# Периодическая фоновая запись: func вызывается раз в interval секунд,
+# stop() останавливает цикл и вызывает func последний раз
+class PeriodicFlusher:
+    def __init__(self, func: Callable[[], Awaitable[None]], interval: float, name: str):
+        self.func = func
+        self.interval = interval
+        self.name = name
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop(), name=self.name)
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self._run()
+
+    async def _run(self):
+        try:
+            await self.func()
+        except Exception as e:
+            logger.error(f"Ошибка фоновой записи {self.name}: {e}")
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self._run()
@@ -0,0 +1,582 @@
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+
+
+# Копия рабочих файлов во временную папку, чтобы не трогать боевую database.db
+def prepare_workdir():
+    workdir = tempfile.mkdtemp(prefix="shop_bot_bench_")
+    for name in ('database.db', '1.png', '2.jpeg'):
+        shutil.copy(os.path.join(ROOT, name), workdir)
+    with open(os.path.join(workdir, 'config.txt'), 'w', encoding='utf-8') as file:
+        file.write("BOT_TOKEN=123456:BENCHMARK-token\nADMINS=1\nPAYMENT_DETAILS=0000 0000 0000 0000\n")
+    os.chdir(workdir)
+    return workdir
+
+
+# Сессия бота без сети: запоминает вызовы и отвечает заглушками
+def make_mock_session(latency: float = 0.0):
+    from aiogram.client.session.base import BaseSession
+    from aiogram.types import Message
+
+    class MockSession(BaseSession):
+        def __init__(self):
+            super().__init__()
+            self.calls = []
+            self._message_ids = itertools.count(1)
+
+        async def make_request(self, bot, method, timeout=None):
+            self.calls.append(type(method).__name__)
+            if latency:
+                await asyncio.sleep(latency)
+            if method.__returning__ is not Message:
+                return True
+            message = {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": getattr(method, "chat_id", None) or 1, "type": "private"},
+            }
+            if type(method).__name__ in ("SendPhoto", "EditMessageMedia"):
+                message["photo"] = [{"file_id": "BENCH-FILE-ID", "file_unique_id": "bench", "width": 1, "height": 1}]
+            return Message.model_validate(message, context={"bot": bot})
+
+        async def stream_content(self, *args, **kwargs):
+            yield b""
+
+        async def close(self):
+            pass
+
+    return MockSession()
+
+
+# Синтетические апдейты Telegram
+update_ids = itertools.count(1)
+
+
+def make_user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+
+def message_update(user_id: int, text: str = None, **extra) -> dict:
+    message = {
+        "message_id": next(update_ids),
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": make_user(user_id),
+    }
+    if text is not None:
+        message["text"] = text
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    message.update(extra)
+    return {"update_id": next(update_ids), "message": message}
+
+
+def callback_update(user_id: int, data: str) -> dict:
+    update_id = next(update_ids)
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id),
+        "chat_instance": str(user_id),
+        "data": data,
+        "from": make_user(user_id),
+        "message": {
+            "message_id": 1,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "caption": "product",
+            "photo": [{"file_id": "BENCH-FILE-ID", "file_unique_id": "bench", "width": 1, "height": 1}],
+        },
+    }}
+
+
+def pre_checkout_update(user_id: int, payload: str, total_amount: int) -> dict:
+    update_id = next(update_ids)
+    return {"update_id": update_id, "pre_checkout_query": {
+        "id": str(update_id),
+        "from": make_user(user_id),
+        "currency": "RUB",
+        "total_amount": total_amount,
+        "invoice_payload": payload,
+    }}
+
+
+def load_bot(latency: float = 0.0):
+    import main as bot_main
+    logging.getLogger().setLevel(logging.WARNING)
+    bot_main.bot.session = make_mock_session(latency)
+    return bot_main
+
+
+def percentile(values, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+def report(name: str, count: int, elapsed: float, latencies=None, unit: str = "апдейтов"):
+    line = f"{name}: {count} {unit} за {elapsed:.2f} с, {count / elapsed:.0f} {unit}/с"
+    if latencies:
+        line += f", p50 {statistics.median(latencies) * 1000:.1f} мс, p99 {percentile(latencies, 0.99) * 1000:.1f} мс"
+    print(line)
+
+
+# N одновременных покупок одного товара из нескольких "процессов"
+async def bench_codes(args):
+    import db
+    from inventory import Inventory
+
+    await db.init()
+    await db.db.executemany(
+        "INSERT INTO products_code (id_product, code) VALUES (?, ?)",
+        [(1, f"BENCH-{i}") for i in range(args.purchases)]
+    )
+    inventories = [Inventory(batch_size=args.batch) for _ in range(args.processes)]
+    for inventory in inventories:
+        await inventory.start()
+
+    start = time.perf_counter()
+    codes = await asyncio.gather(*(
+        inventories[i % args.processes].claim(1, i) for i in range(args.purchases)
+    ))
+    elapsed = time.perf_counter() - start
+
+    for inventory in inventories:
+        await inventory.stop()
+    claimed = await db.db.fetchone("SELECT COUNT(*), COUNT(DISTINCT code) FROM products_code WHERE claimed_by IS NOT NULL")
+    await db.close()
+
+    issued = [code for code in codes if code]
+    print(f"Покупок: {args.purchases}, процессов: {args.processes}, пачка: {args.batch}")
+    print(f"Выдано кодов: {len(issued)}, уникальных: {len(set(issued))}, отмечено в БД: {claimed[0]}")
+    print(f"Время: {elapsed * 1000:.1f} мс, {args.purchases / elapsed:.0f} покупок/с")
+    if len(issued) != len(set(issued)) or claimed[0] != claimed[1]:
+        print("ОШИБКА: один код выдан несколько раз")
+        return 1
+    return 0
+
+
+# Нагрузка на вебхук: POST синтетических апдейтов в локальный aiohttp-сервер
+async def bench_webhook(args):
+    from aiohttp import ClientSession
+    from aiohttp.test_utils import TestServer
+    from webhook import create_app
+
+    bot_main = load_bot(args.latency)
+    app = create_app(bot_main.dp, bot_main.bot, path='/webhook', secret='bench-secret')
+    server = TestServer(app)
+    await server.start_server()
+    url = str(server.make_url('/webhook'))
+    headers = {"X-Telegram-Bot-Api-Secret-Token": "bench-secret"}
+    updates = [message_update(1000 + i % args.users, "/menu") for i in range(args.updates)]
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def post(client, update):
+        async with semaphore:
+            async with client.post(url, json=update, headers=headers) as response:
+                assert response.status == 200, response.status
+
+    async with ClientSession() as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(post(client, update) for update in updates))
+        await app['webhook_handler'].drain(timeout=60)
+        elapsed = time.perf_counter() - start
+    await server.close()
+
+    report("webhook", args.updates, elapsed)
+    print(f"Вызовов Bot API: {len(bot_main.bot.session.calls)}")
+    return 0
+
+
+# Прогон сценариев через dp.feed_update: каждый пользователь шлёт свои апдейты
+# последовательно, пользователи работают параллельно
+class HandlerBench:
+    def __init__(self, bot_main, concurrency: int):
+        self.bot_main = bot_main
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.latencies = []
+        self.queries = 0
+        observe = bot_main.db.db.on_query
+
+        def count_query(name, seconds):
+            self.queries += 1
+            if observe:
+                observe(name, seconds)
+        bot_main.db.db.on_query = count_query
+
+    async def feed(self, update: dict):
+        from aiogram.types import Update
+
+        update = Update.model_validate(update, context={"bot": self.bot_main.bot})
+        start = time.perf_counter()
+        await self.bot_main.dp.feed_update(self.bot_main.bot, update)
+        self.latencies.append(time.perf_counter() - start)
+
+    async def run(self, name: str, sessions):
+        async def limited(session):
+            async with self.semaphore:
+                await session
+        self.latencies = []
+        self.queries = 0
+        calls_before = len(self.bot_main.bot.session.calls)
+        start = time.perf_counter()
+        await asyncio.gather(*(limited(session) for session in sessions))
+        elapsed = time.perf_counter() - start
+        count = len(self.latencies)
+        report(name, count, elapsed, self.latencies)
+        api_calls = len(self.bot_main.bot.session.calls) - calls_before
+        print(f"  SQL-запросов на апдейт: {self.queries / count:.2f}, вызовов Bot API на апдейт: {api_calls / count:.2f}")
+        return {
+            "updates": count,
+            "updates_per_sec": count / elapsed,
+            "p50_ms": percentile(self.latencies, 0.5) * 1000,
+            "p99_ms": percentile(self.latencies, 0.99) * 1000,
+            "queries_per_update": self.queries / count,
+            "api_calls_per_update": api_calls / count,
+        }
+
+
+# Сценарии нагрузки на хендлеры: шторм листания, волна /start, одновременные покупки
+async def bench_handlers(args):
+    from keyboards import ProductCallback
+    from notifier import Notifier
+
+    bot_main = load_bot(args.latency)
+    bot_main.NAV_DEBOUNCE = args.debounce
+    # лимиты Telegram на рассылку уведомлений в бенчмарке не нужны
+    bot_main.notifier = Notifier(bot_main.bot, global_rate=1e9, chat_rate=1e9)
+    # Все апдейты идут от синтетических пользователей подряд, ограничение частоты исказило бы замер
+    bot_main.throttling.limits.clear()
+    await bot_main.on_startup()
+    await bot_main.db.db.executemany(
+        "INSERT INTO products_code (id_product, code) VALUES (?, ?)",
+        [(1, f"BENCH-{i}") for i in range(args.users)]
+    )
+    await bot_main.inventory.refresh_stock()
+    version = await bot_main.catalog.get_version()
+    bench = HandlerBench(bot_main, args.concurrency)
+    users = range(10000, 10000 + args.users)
+    results = {}
+
+    async def start_session(user_id):
+        for _ in range(args.repeat):
+            await bench.feed(message_update(user_id, "/start"))
+
+    async def browse_session(user_id):
+        await bench.feed(message_update(user_id, "📦 Товары"))
+        for step in range(args.repeat):
+            action = "next" if step % 3 else "prev"
+            data = ProductCallback(action=action, product_id=1 + step % 2, version=version).pack()
+            await bench.feed(callback_update(user_id, data))
+
+    async def checkout_session(user_id):
+        await bench.feed(callback_update(user_id, ProductCallback(action="buy", product_id=1, version=version).pack()))
+        await bench.feed(callback_update(user_id, "pay_online"))
+        await bench.feed(pre_checkout_update(user_id, f"{user_id}_1", 109900))
+        await bench.feed(message_update(user_id, successful_payment={
+            "currency": "RUB",
+            "total_amount": 109900,
+            "invoice_payload": f"{user_id}_1",
+            "telegram_payment_charge_id": f"charge-{user_id}",
+            "provider_payment_charge_id": f"provider-{user_id}",
+        }))
+
+    scenarios = {
+        "start": start_session,
+        "browse": browse_session,
+        "checkout": checkout_session,
+    }
+    for name in args.scenarios:
+        if name not in scenarios:
+            print(f"Неизвестный сценарий: {name}")
+            continue
+        results[name] = await bench.run(name, [scenarios[name](user_id) for user_id in users])
+
+    await bot_main.on_shutdown()
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as file:
+            baseline = json.load(file)
+        print("\nСравнение с базовым прогоном:")
+        for name, result in results.items():
+            if name not in baseline:
+                continue
+            before = baseline[name]
+            print(
+                f"{name}: {before['updates_per_sec']:.0f} -> {result['updates_per_sec']:.0f} апдейтов/с, "
+                f"p99 {before['p99_ms']:.1f} -> {result['p99_ms']:.1f} мс, "
+                f"SQL/апдейт {before['queries_per_update']:.2f} -> {result['queries_per_update']:.2f}"
+            )
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as file:
+            json.dump(results, file, ensure_ascii=False, indent=2)
+    return 0
+
+
+# Задержки get/set состояния FSM: MemoryStorage против SQLiteStorage
+async def bench_fsm(args):
+    import db
+    from aiogram.fsm.storage.base import StorageKey
+    from aiogram.fsm.storage.memory import MemoryStorage
+    from fsm_storage import SQLiteStorage
+
+    await db.init()
+
+    async def simulate(storage, user_id, latencies):
+        key = StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+        for step in range(args.steps):
+            start = time.perf_counter()
+            await storage.set_state(key, f"State:{step}")
+            await storage.update_data(key, {"order_id": f"{user_id}-{step}"})
+            await storage.get_state(key)
+            await storage.get_data(key)
+            latencies.append(time.perf_counter() - start)
+
+    storages = [
+        ("MemoryStorage", MemoryStorage()),
+        ("SQLiteStorage", SQLiteStorage(cache_size=args.users * 2)),
+        ("SQLiteStorage (кэш 10%)", SQLiteStorage(cache_size=args.users // 10)),
+    ]
+    for name, storage in storages:
+        if isinstance(storage, SQLiteStorage):
+            await storage.start()
+        latencies = []
+        start = time.perf_counter()
+        await asyncio.gather(*(simulate(storage, user_id, latencies) for user_id in range(args.users)))
+        elapsed = time.perf_counter() - start
+        await storage.close()
+        report(name, len(latencies), elapsed, latencies, unit="циклов get/set")
+    await db.close()
+    return 0
+
+
+# Полнотекстовый поиск по большому каталогу: запросы мимо кэша и из кэша
+async def bench_search(args):
+    import random
+    import db
+    from catalog import CatalogCache
+    from search import ProductSearch
+
+    await db.init()
+    words = ["антивирус", "подписка", "ключ", "игра", "стикеры", "акула", "премиум", "курс", "музыка", "кино"]
+    rng = random.Random(1)
+    rows = [
+        (f"Товар {index} {rng.choice(words)}", f"{rng.choice(words)} {rng.choice(words)} №{index}",
+         100000 + index, None)
+        for index in range(args.products)
+    ]
+    start = time.perf_counter()
+    await db.db.executemany("INSERT INTO products (name, description, price, photo) VALUES (?, ?, ?, ?)", rows)
+    print(f"Добавлено {args.products} товаров за {time.perf_counter() - start:.1f} с")
+
+    search = ProductSearch(CatalogCache())
+    queries = [rng.choice(words)[:rng.randint(3, 6)] + (f" {rng.randint(1, 999)}" if rng.random() < 0.5 else "")
+               for _ in range(args.queries)]
+    # Второй проход повторяет те же запросы и попадает в LRU-кэш
+    for name in ("без кэша", "из кэша"):
+        latencies = []
+        start = time.perf_counter()
+        for query in queries:
+            query_start = time.perf_counter()
+            await search.search(query)
+            latencies.append(time.perf_counter() - query_start)
+        report(f"Поиск ({name})", len(queries), time.perf_counter() - start, latencies, unit="запросов")
+    await db.close()
+    return 0
+
+
+# Импорт большого файла кодов: поток кусками по 64 КБ, как при скачивании из Telegram.
+# Файл на миллион кодов больше 20 МБ: через чат его примет только локальный сервер Bot API
+async def bench_import(args):
+    import db
+    from importer import import_codes
+
+    await db.init()
+
+    async def chunks():
+        lines = []
+        for index in range(args.codes):
+            # Каждый десятый код - повтор, чтобы нагрузить дедупликацию
+            lines.append(f"1,BENCH-{index - index % 10 if index % 10 == 9 else index:012d}\n")
+            if len(lines) == 4096:
+                yield "".join(lines).encode()
+                lines.clear()
+                await asyncio.sleep(0)
+        yield "".join(lines).encode()
+
+    # Задержки event loop во время импорта: бот должен оставаться отзывчивым
+    stalls = []
+    done = asyncio.Event()
+
+    async def probe():
+        while not done.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(0.01)
+            stalls.append(time.perf_counter() - start - 0.01)
+
+    probe_task = asyncio.create_task(probe())
+    start = time.perf_counter()
+    stats = await import_codes(chunks(), batch_size=args.batch)
+    elapsed = time.perf_counter() - start
+    done.set()
+    await probe_task
+    report("Импорт кодов", stats.rows, elapsed, unit="строк")
+    print(f"Добавлено {stats.inserted}, дубликатов {stats.duplicates}, отклонено {stats.rejected}; "
+          f"задержка event loop p99 {percentile(stalls, 0.99) * 1000:.1f} мс, макс {max(stalls) * 1000:.1f} мс")
+    await db.close()
+    return 0
+
+
+# Отчёт о продажах на большой истории заказов: сводки не зависят от числа заказов
+async def bench_report(args):
+    import random
+    import db
+
+    await db.init()
+    rng = random.Random(1)
+    now = int(time.time())
+    rows = [
+        (rng.randint(1, 100000), rng.choice((1, 2)), f"bench-{index}", "paid", 100,
+         now - rng.randint(0, 365 * 86400))
+        for index in range(args.orders)
+    ]
+    start = time.perf_counter()
+    await db.db.executemany(
+        "INSERT INTO orders (tg_id, product, order_id, status, amount, created_at) VALUES (?, ?, ?, ?, ?, ?)", rows
+    )
+    report("Запись заказов со сводками", args.orders, time.perf_counter() - start, unit="заказов")
+
+    today = now // 86400
+    for name, query in (
+        ("По дням за 30 дней", lambda: db.get_sales_by_period(today - 29, 1)),
+        ("По неделям за год", lambda: db.get_sales_by_period(today - 364, 7)),
+        ("По товарам за год", lambda: db.get_sales_by_product(today - 364, 20)),
+    ):
+        latencies = []
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            query_start = time.perf_counter()
+            await query()
+            latencies.append(time.perf_counter() - query_start)
+        report(name, args.repeat, time.perf_counter() - start, latencies, unit="запросов")
+    await db.close()
+    return 0
+
+
+# CPU на отрисовку карточки товара и меню: сборка и сериализация заново против готовых объектов
+async def bench_render(args):
+    import db
+    from aiogram import Bot
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.methods import SendMessage, SendPhoto
+    from catalog import CatalogCache
+    from keyboards import get_main_menu, get_product_nav
+    from render import ProductRenderCache, RenderSession, get_product_caption
+
+    await db.init()
+    catalog = CatalogCache()
+    products = await catalog.get_all()
+    version = await catalog.get_version()
+    cards = ProductRenderCache(catalog)
+    bot = Bot(token="123456:BENCHMARK-token")
+    plain_session, render_session = AiohttpSession(), RenderSession()
+
+    async def uncached(product):
+        caption = get_product_caption(product)
+        reply_markup = get_product_nav.__wrapped__(product[0], version)
+        plain_session.build_form_data(bot, SendPhoto(chat_id=1, photo="FILE-ID", caption=caption,
+                                                     reply_markup=reply_markup, parse_mode="HTML"))
+        plain_session.build_form_data(bot, SendMessage(chat_id=1, text="menu", reply_markup=get_main_menu.__wrapped__()))
+
+    async def cached(product):
+        caption, reply_markup = await cards.get(product)
+        render_session.build_form_data(bot, SendPhoto(chat_id=1, photo="FILE-ID", caption=caption,
+                                                      reply_markup=reply_markup, parse_mode="HTML"))
+        render_session.build_form_data(bot, SendMessage(chat_id=1, text="menu", reply_markup=get_main_menu()))
+
+    results = {}
+    for name, render in (("Без кэша", uncached), ("С кэшем", cached)):
+        start = time.process_time()
+        for index in range(args.updates):
+            await render(products[index % len(products)])
+        results[name] = (time.process_time() - start) / args.updates
+        print(f"{name}: {results[name] * 1e6:.1f} мкс CPU на апдейт (карточка товара + меню)")
+    saved = results["Без кэша"] - results["С кэшем"]
+    print(f"Экономия: {saved * 1e6:.1f} мкс CPU на апдейт ({saved / results['Без кэша'] * 100:.0f}%)")
+    await db.close()
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки shop_bot")
+    sub = parser.add_subparsers(dest="scenario", required=True)
+
+    codes = sub.add_parser("codes", help="конкурентная выдача кодов")
+    codes.add_argument("--purchases", type=int, default=1000)
+    codes.add_argument("--processes", type=int, default=4)
+    codes.add_argument("--batch", type=int, default=5)
+    codes.set_defaults(func=bench_codes)
+
+    webhook = sub.add_parser("webhook", help="пропускная способность вебхука")
+    webhook.add_argument("--updates", type=int, default=2000)
+    webhook.add_argument("--users", type=int, default=500)
+    webhook.add_argument("--concurrency", type=int, default=50)
+    webhook.add_argument("--latency", type=float, default=0.0, help="задержка ответа Bot API, с")
+    webhook.set_defaults(func=bench_webhook)
+
+    handlers = sub.add_parser("handlers", help="сценарии нагрузки на хендлеры бота")
+    handlers.add_argument("scenarios", nargs="*", default=["start", "browse", "checkout"],
+                          help="start, browse, checkout (по умолчанию все)")
+    handlers.add_argument("--users", type=int, default=500)
+    handlers.add_argument("--repeat", type=int, default=5, help="апдейтов на пользователя в start/browse")
+    handlers.add_argument("--concurrency", type=int, default=100)
+    handlers.add_argument("--latency", type=float, default=0.0, help="задержка ответа Bot API, с")
+    handlers.add_argument("--debounce", type=float, default=0.0, help="NAV_DEBOUNCE для листания, с")
+    handlers.add_argument("--save", help="сохранить результаты в JSON")
+    handlers.add_argument("--baseline", help="сравнить с сохранённым JSON")
+    handlers.set_defaults(func=bench_handlers)
+
+    fsm = sub.add_parser("fsm", help="хранилища состояний FSM")
+    fsm.add_argument("--users", type=int, default=10000)
+    fsm.add_argument("--steps", type=int, default=3)
+    fsm.set_defaults(func=bench_fsm)
+
+    search = sub.add_parser("search", help="полнотекстовый поиск по каталогу")
+    search.add_argument("--products", type=int, default=100000)
+    search.add_argument("--queries", type=int, default=500)
+    search.set_defaults(func=bench_search)
+
+    codes_import = sub.add_parser("import", help="потоковый импорт кодов")
+    codes_import.add_argument("--codes", type=int, default=1000000)
+    codes_import.add_argument("--batch", type=int, default=10000)
+    codes_import.set_defaults(func=bench_import)
+
+    sales_report = sub.add_parser("report", help="отчёт о продажах на большой истории заказов")
+    sales_report.add_argument("--orders", type=int, default=200000)
+    sales_report.add_argument("--repeat", type=int, default=200)
+    sales_report.set_defaults(func=bench_report)
+
+    render = sub.add_parser("render", help="CPU на подписи и клавиатуры")
+    render.add_argument("--updates", type=int, default=20000)
+    render.set_defaults(func=bench_render)
+
+    args = parser.parse_args()
+    workdir = prepare_workdir()
+    try:
+        return asyncio.run(args.func(args))
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+import db
+
+logger = logging.getLogger(__name__)
+
+# id, название, описание, цена, фото, миниатюра
+Product = Tuple[int, str, str, int, str, Optional[str]]
+
+
+# Кэш каталога товаров в памяти
+class CatalogCache:
+    def __init__(self, ttl: float = 30.0):
+        self.ttl = ttl
+        self.version = -1
+        self.hits = 0
+        self.misses = 0
+        self._products: List[Product] = []
+        self._by_id: Dict[int, int] = {}
+        self._neighbors: Dict[int, Tuple[int, int]] = {}
+        self._checked_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def invalidate(self):
+        self._checked_at = 0.0
+        self.version = -1
+
+    # Перечитывает каталог, если истёк TTL и версия в БД изменилась
+    async def _refresh(self):
+        if self.version >= 0 and time.monotonic() - self._checked_at < self.ttl:
+            self.hits += 1
+            return
+
+        async with self._lock:
+            if self.version >= 0 and time.monotonic() - self._checked_at < self.ttl:
+                self.hits += 1
+                return
+            version = await db.get_catalog_version()
+            if version == self.version:
+                self.hits += 1
+            else:
+                self.misses += 1
+                self._products = await db.get_products()
+                self._by_id = {product[0]: index for index, product in enumerate(self._products)}
+                ids = [product[0] for product in self._products]
+                self._neighbors = {
+                    product_id: (ids[index - 1], ids[(index + 1) % len(ids)])
+                    for index, product_id in enumerate(ids)
+                }
+                self.version = version
+                logger.info(f"Каталог загружен в кэш: {len(self._products)} товаров (версия {version})")
+            self._checked_at = time.monotonic()
+
+    async def get_all(self) -> List[Product]:
+        await self._refresh()
+        return self._products
+
+    async def get_first(self) -> Optional[Product]:
+        await self._refresh()
+        return self._products[0] if self._products else None
+
+    # Товар по id: из кэша, а если его там ещё нет - по первичному ключу из БД
+    async def get_by_id(self, product_id: int) -> Optional[Product]:
+        await self._refresh()
+        index = self._by_id.get(product_id)
+        if index is not None:
+            return self._products[index]
+        return await db.get_product(product_id)
+
+    # id предыдущего и следующего товара (по кругу)
+    async def get_neighbors(self, product_id: int) -> Optional[Tuple[int, int]]:
+        await self._refresh()
+        return self._neighbors.get(product_id)
+
+    # Страница каталога и общее число страниц
+    async def get_page(self, page: int, size: int) -> Tuple[List[Product], int]:
+        await self._refresh()
+        pages = max(1, -(-len(self._products) // size))
+        page = min(max(page, 0), pages - 1)
+        return self._products[page * size:(page + 1) * size], pages
+
+    async def get_version(self) -> int:
+        await self._refresh()
+        return self.version
+
+    async def count(self) -> int:
+        await self._refresh()
+        return len(self._products)
+
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'version': self.version, 'size': len(self._products)}
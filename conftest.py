@@ -0,0 +1,16 @@
+import asyncio
+import shutil
+
+import pytest
+
+import db
+
+
+@pytest.fixture
+def sqlite_db(tmp_path, monkeypatch):
+    # Копия database.db, чтобы тесты не меняли рабочую базу
+    path = tmp_path / 'database.db'
+    shutil.copy('database.db', path)
+    monkeypatch.setattr(db, 'db', db.Database(str(path)))
+    yield
+    asyncio.run(db.close())
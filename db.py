@@ -0,0 +1,622 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+# Схема, которая досоздаётся при запуске поверх существующей database.db
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS catalog_version (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL);
+INSERT OR IGNORE INTO catalog_version (id, version) VALUES (1, 0);
+CREATE TRIGGER IF NOT EXISTS products_version_ins AFTER INSERT ON products
+BEGIN UPDATE catalog_version SET version = version + 1 WHERE id = 1; END;
+CREATE TRIGGER IF NOT EXISTS products_version_upd AFTER UPDATE ON products
+BEGIN UPDATE catalog_version SET version = version + 1 WHERE id = 1; END;
+CREATE TRIGGER IF NOT EXISTS products_version_del AFTER DELETE ON products
+BEGIN UPDATE catalog_version SET version = version + 1 WHERE id = 1; END;
+CREATE INDEX IF NOT EXISTS idx_products_code_free ON products_code (id_product)
+    WHERE reserved_by IS NULL AND claimed_by IS NULL;
+CREATE TABLE IF NOT EXISTS pending_orders (
+    order_id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_pending_orders_expires ON pending_orders (expires_at);
+CREATE TABLE IF NOT EXISTS media_cache (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    file_id TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS dead_letters (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER NOT NULL,
+    method TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    error TEXT NOT NULL,
+    created_at INTEGER NOT NULL DEFAULT (strftime('%s', 'now'))
+);
+CREATE INDEX IF NOT EXISTS idx_orders_user_created ON orders (tg_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_orders_code ON orders (code);
+CREATE TABLE IF NOT EXISTS payments (
+    charge_id TEXT PRIMARY KEY,
+    tg_id INTEGER NOT NULL,
+    product_id INTEGER NOT NULL,
+    amount INTEGER NOT NULL,
+    created_at INTEGER NOT NULL DEFAULT (strftime('%s', 'now')),
+    recovering INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_payments_created ON payments (created_at);
+CREATE TABLE IF NOT EXISTS user_stats (
+    tg_id INTEGER PRIMARY KEY,
+    orders_count INTEGER NOT NULL,
+    total_spent INTEGER NOT NULL,
+    last_order_at INTEGER NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS orders_user_stats AFTER INSERT ON orders
+WHEN NEW.status IN ('paid', 'confirmed')
+BEGIN
+    INSERT INTO user_stats (tg_id, orders_count, total_spent, last_order_at)
+    VALUES (NEW.tg_id, 1, NEW.amount, NEW.created_at)
+    ON CONFLICT (tg_id) DO UPDATE SET
+        orders_count = orders_count + 1,
+        total_spent = total_spent + excluded.total_spent,
+        last_order_at = excluded.last_order_at;
+END;
+CREATE TABLE IF NOT EXISTS sales_daily (
+    day INTEGER NOT NULL,
+    product_id INTEGER NOT NULL,
+    views INTEGER NOT NULL DEFAULT 0,
+    checkouts INTEGER NOT NULL DEFAULT 0,
+    units INTEGER NOT NULL DEFAULT 0,
+    revenue INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, product_id)
+) WITHOUT ROWID;
+CREATE TRIGGER IF NOT EXISTS orders_sales_daily AFTER INSERT ON orders
+WHEN NEW.status IN ('paid', 'confirmed')
+BEGIN
+    INSERT INTO sales_daily (day, product_id, units, revenue)
+    VALUES (NEW.created_at / 86400, NEW.product, 1, COALESCE(NEW.amount, 0))
+    ON CONFLICT (day, product_id) DO UPDATE SET
+        units = units + 1,
+        revenue = revenue + excluded.revenue;
+END;
+CREATE TABLE IF NOT EXISTS fsm_storage (
+    key TEXT PRIMARY KEY,
+    state TEXT,
+    data TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_fsm_storage_updated ON fsm_storage (updated_at);
+CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+    name, description, content='products', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+);
+CREATE TRIGGER IF NOT EXISTS products_fts_ins AFTER INSERT ON products
+BEGIN
+    INSERT INTO products_fts (rowid, name, description) VALUES (NEW.id, NEW.name, NEW.description);
+END;
+CREATE TRIGGER IF NOT EXISTS products_fts_del AFTER DELETE ON products
+BEGIN
+    INSERT INTO products_fts (products_fts, rowid, name, description) VALUES ('delete', OLD.id, OLD.name, OLD.description);
+END;
+CREATE TRIGGER IF NOT EXISTS products_fts_upd AFTER UPDATE OF name, description ON products
+BEGIN
+    INSERT INTO products_fts (products_fts, rowid, name, description) VALUES ('delete', OLD.id, OLD.name, OLD.description);
+    INSERT INTO products_fts (rowid, name, description) VALUES (NEW.id, NEW.name, NEW.description);
+END;
+CREATE TRIGGER IF NOT EXISTS products_photo_reset AFTER UPDATE OF photo ON products
+WHEN NEW.photo IS NOT OLD.photo
+BEGIN
+    UPDATE products SET photo_file = NULL, thumb_file = NULL WHERE id = NEW.id;
+END;
+"""
+
+# Колонки, которых нет в исходной database.db
+COLUMNS = [
+    ('products_code', 'reserved_by', 'TEXT'),
+    ('products_code', 'claimed_by', 'INTEGER'),
+    ('products_code', 'claimed_at', 'INTEGER'),
+    ('products_code', 'reserved_at', 'INTEGER'),
+    ('orders', 'order_id', 'TEXT'),
+    ('orders', 'status', 'TEXT'),
+    ('orders', 'amount', 'INTEGER'),
+    ('orders', 'code', 'TEXT'),
+    ('orders', 'method', 'TEXT'),
+    ('orders', 'created_at', 'INTEGER'),
+    ('products', 'photo_file', 'TEXT'),
+    ('products', 'thumb_file', 'TEXT'),
+    ('payments', 'recovering', 'INTEGER NOT NULL DEFAULT 0'),
+]
+
+# Запросы (sqlite держит подготовленные выражения в кэше каждого соединения)
+GET_USER_IDS = "SELECT tg_id FROM users"
+UPSERT_USER = """
+INSERT INTO users (tg_id, username, full_name) VALUES (?, ?, ?)
+ON CONFLICT (tg_id) DO UPDATE SET username = excluded.username, full_name = excluded.full_name
+"""
+GET_USERS_PAGE = "SELECT id, tg_id FROM users WHERE id > ? ORDER BY id LIMIT ?"
+# Фото товара - подготовленная копия, пока она есть, иначе исходный файл
+GET_PRODUCTS = """
+SELECT id, name, description, price, COALESCE(photo_file, photo), thumb_file FROM products ORDER BY id
+"""
+GET_PRODUCT = "SELECT id, name, description, price, COALESCE(photo_file, photo), thumb_file FROM products WHERE id = ?"
+GET_PRODUCT_PHOTOS = "SELECT id, photo, photo_file, thumb_file FROM products WHERE photo IS NOT NULL"
+SET_PRODUCT_PHOTOS = "UPDATE products SET photo_file = ?, thumb_file = ? WHERE id = ? AND photo = ?"
+# Ранжируем только первые совпадения: bm25 по всем строкам для коротких префиксов слишком дорог
+SEARCH_PRODUCTS = """
+SELECT p.id, p.name, p.description, p.price, COALESCE(p.photo_file, p.photo), p.thumb_file
+FROM (SELECT rowid, rank FROM products_fts WHERE products_fts MATCH ? LIMIT ?) AS found
+JOIN products p ON p.id = found.rowid
+ORDER BY found.rank
+LIMIT ?
+"""
+GET_CATALOG_VERSION = "SELECT version FROM catalog_version WHERE id = 1"
+RESERVE_CODES = """
+UPDATE products_code SET reserved_by = ?, reserved_at = ?
+WHERE rowid IN (
+    SELECT rowid FROM products_code
+    WHERE id_product = ? AND reserved_by IS NULL AND claimed_by IS NULL
+    LIMIT ?
+)
+RETURNING rowid, code
+"""
+PUT_PENDING_ORDER = "INSERT OR REPLACE INTO pending_orders (order_id, user_id, data, expires_at) VALUES (?, ?, ?, ?)"
+TOUCH_PENDING_ORDER = """
+UPDATE pending_orders SET expires_at = ? + ? WHERE order_id = ? AND expires_at > ? RETURNING data
+"""
+DELETE_PENDING_ORDER = "DELETE FROM pending_orders WHERE order_id = ?"
+TAKE_PENDING_ORDER = "DELETE FROM pending_orders WHERE order_id = ? AND expires_at > ? RETURNING data"
+PURGE_PENDING_ORDERS = """
+DELETE FROM pending_orders WHERE expires_at <= ? OR order_id IN (
+    SELECT order_id FROM pending_orders ORDER BY expires_at DESC LIMIT -1 OFFSET ?
+)
+"""
+GET_MEDIA_CACHE = "SELECT path, mtime_ns, size, file_id FROM media_cache"
+PUT_MEDIA_CACHE = "INSERT OR REPLACE INTO media_cache (path, mtime_ns, size, file_id) VALUES (?, ?, ?, ?)"
+DELETE_MEDIA_CACHE = "DELETE FROM media_cache WHERE path = ?"
+ADD_DEAD_LETTER = "INSERT INTO dead_letters (chat_id, method, payload, error) VALUES (?, ?, ?, ?)"
+GET_FSM = "SELECT state, data, updated_at FROM fsm_storage WHERE key = ?"
+GET_FSM_UPDATED_AT = "SELECT key, updated_at FROM fsm_storage WHERE key IN (SELECT value FROM json_each(?))"
+PUT_FSM = """
+INSERT INTO fsm_storage (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+ON CONFLICT (key) DO UPDATE SET state = excluded.state, data = excluded.data, updated_at = excluded.updated_at
+"""
+DELETE_FSM = "DELETE FROM fsm_storage WHERE key = ?"
+PURGE_FSM = "DELETE FROM fsm_storage WHERE updated_at < ?"
+INSERT_CODES = "INSERT OR IGNORE INTO products_code (id_product, code) VALUES (?, ?)"
+INSERT_PRODUCTS = "INSERT OR IGNORE INTO products (name, description, price, photo) VALUES (?, ?, ?, ?)"
+GET_PRODUCT_IDS = "SELECT id FROM products"
+CLAIM_CODE = "UPDATE products_code SET claimed_by = ?, claimed_at = ? WHERE rowid = ? AND reserved_by = ?"
+RELEASE_CODES = """
+UPDATE products_code SET reserved_by = NULL, reserved_at = NULL
+WHERE rowid = ? AND reserved_by = ? AND claimed_by IS NULL
+"""
+RECLAIM_CODES = """
+UPDATE products_code SET reserved_by = NULL, reserved_at = NULL
+WHERE reserved_by IS NOT NULL AND reserved_by != ? AND claimed_by IS NULL AND COALESCE(reserved_at, 0) < ?
+    AND NOT EXISTS (SELECT 1 FROM orders WHERE orders.code = products_code.code)
+"""
+COUNT_FREE_CODES = """
+SELECT id_product, COUNT(*) FROM products_code
+WHERE reserved_by IS NULL AND claimed_by IS NULL
+GROUP BY id_product
+"""
+ADD_PAYMENT = "INSERT OR IGNORE INTO payments (charge_id, tg_id, product_id, amount) VALUES (?, ?, ?, ?)"
+GET_RECENT_PAYMENTS = "SELECT charge_id FROM payments ORDER BY created_at DESC LIMIT ?"
+START_PAYMENT_RECOVERY = "UPDATE payments SET recovering = 1 WHERE charge_id = ? AND recovering = 0 RETURNING charge_id"
+GET_ORDER_CODE = "SELECT code FROM orders WHERE order_id = ?"
+GET_PAYMENT_ORDER = """
+SELECT p.created_at, o.rowid, o.code FROM payments p
+LEFT JOIN orders o ON o.order_id = p.charge_id
+WHERE p.charge_id = ?
+"""
+COUNT_STALE_RESERVATIONS = """
+SELECT COUNT(*) FROM products_code WHERE reserved_by IS NOT NULL AND reserved_by != ? AND claimed_by IS NULL
+"""
+ADD_ORDER = """
+INSERT INTO orders (tg_id, product, order_id, status, amount, code, method, created_at)
+VALUES (?, ?, ?, ?, ?, ?, ?, strftime('%s', 'now'))
+"""
+ADD_SALES_ACTIVITY = """
+INSERT INTO sales_daily (day, product_id, views, checkouts) VALUES (?, ?, ?, ?)
+ON CONFLICT (day, product_id) DO UPDATE SET
+    views = views + excluded.views,
+    checkouts = checkouts + excluded.checkouts
+"""
+# Недели считаются с понедельника: 1970-01-01 был четвергом
+GET_SALES_BY_PERIOD = """
+SELECT (day + ?) / ? AS period, SUM(views), SUM(checkouts), SUM(units), SUM(revenue)
+FROM sales_daily WHERE day >= ?
+GROUP BY period ORDER BY period
+"""
+GET_SALES_BY_PRODUCT = """
+SELECT s.product_id, p.name, SUM(s.views), SUM(s.checkouts), SUM(s.units), SUM(s.revenue)
+FROM sales_daily s LEFT JOIN products p ON p.id = s.product_id
+WHERE s.day >= ?
+GROUP BY s.product_id ORDER BY SUM(s.revenue) DESC, SUM(s.views) DESC
+LIMIT ?
+"""
+GET_SALES_PAGE = """
+SELECT s.day, s.product_id, p.name, s.views, s.checkouts, s.units, s.revenue
+FROM sales_daily s LEFT JOIN products p ON p.id = s.product_id
+WHERE (s.day, s.product_id) > (?, ?)
+ORDER BY s.day, s.product_id
+LIMIT ?
+"""
+GET_USER_STATS = "SELECT orders_count, total_spent, last_order_at FROM user_stats WHERE tg_id = ?"
+GET_ORDER_HISTORY = """
+SELECT o.rowid, o.created_at, o.status, o.amount, o.code, p.name
+FROM orders o LEFT JOIN products p ON p.id = o.product
+WHERE o.tg_id = ? AND (o.created_at, o.rowid) < (?, ?)
+ORDER BY o.created_at DESC, o.rowid DESC
+LIMIT ?
+"""
+
+
+# Пул долгоживущих соединений, запросы выполняются в отдельных потоках
+class Database:
+    def __init__(self, path: str = 'database.db', pool_size: int = 4):
+        self.path = path
+        self.pool_size = pool_size
+        self._pool: Optional[asyncio.Queue] = None
+        self._connections: List[sqlite3.Connection] = []
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # Вызывается после каждого запроса с его именем и длительностью
+        self.on_query: Optional[Callable[[str, float], None]] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    async def open(self):
+        if self._pool is not None:
+            return
+        self._executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="db")
+        loop = asyncio.get_running_loop()
+        self._pool = asyncio.Queue()
+        for _ in range(self.pool_size):
+            conn = await loop.run_in_executor(self._executor, self._connect)
+            self._connections.append(conn)
+            self._pool.put_nowait(conn)
+        await self.run(self._migrate)
+        logger.info(f"БД открыта: {self.path}, соединений в пуле: {self.pool_size}")
+
+    def _migrate(self, conn: sqlite3.Connection):
+        for table, column, decl in COLUMNS:
+            existing = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+            # Таблицы, которых ещё нет, создаст SCHEMA сразу с новыми колонками
+            if existing and column not in existing:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+        # Уникальный tg_id: сначала убираем дубликаты, накопившиеся до индекса
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_users_tg_id'").fetchone():
+            with conn:
+                conn.execute("DELETE FROM users WHERE id NOT IN (SELECT MIN(id) FROM users GROUP BY tg_id)")
+                conn.execute("CREATE UNIQUE INDEX idx_users_tg_id ON users (tg_id)")
+        # Уникальный код товара: из дубликатов оставляем уже выданный, иначе самый ранний
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_products_code_code'").fetchone():
+            with conn:
+                conn.execute("""
+                    DELETE FROM products_code WHERE rowid IN (
+                        SELECT rowid FROM (
+                            SELECT rowid, ROW_NUMBER() OVER (PARTITION BY code ORDER BY claimed_by IS NULL, rowid) AS n
+                            FROM products_code WHERE code IS NOT NULL
+                        ) WHERE n > 1
+                    )
+                """)
+                conn.execute("CREATE UNIQUE INDEX idx_products_code_code ON products_code (code)")
+        # Один заказ - одна запись в истории: из дубликатов оставляем самую раннюю
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_orders_order_id'").fetchone():
+            with conn:
+                conn.execute("""
+                    DELETE FROM orders WHERE order_id IS NOT NULL AND rowid NOT IN (
+                        SELECT MIN(rowid) FROM orders WHERE order_id IS NOT NULL GROUP BY order_id
+                    )
+                """)
+                conn.execute("CREATE UNIQUE INDEX idx_orders_order_id ON orders (order_id)")
+        fts_exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'products_fts'").fetchone()
+        sales_exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'sales_daily'").fetchone()
+        conn.executescript(SCHEMA)
+        # Новый индекс поиска заполняем уже существующими товарами
+        if not fts_exists:
+            with conn:
+                conn.execute("INSERT INTO products_fts (products_fts) VALUES ('rebuild')")
+        # Новые сводки продаж заполняем по уже записанным заказам, дальше их ведёт триггер
+        if not sales_exists:
+            with conn:
+                conn.execute("""
+                    INSERT INTO sales_daily (day, product_id, units, revenue)
+                    SELECT created_at / 86400, product, COUNT(*), COALESCE(SUM(amount), 0) FROM orders
+                    WHERE status IN ('paid', 'confirmed') AND created_at IS NOT NULL AND product IS NOT NULL
+                    GROUP BY created_at / 86400, product
+                """)
+
+    async def close(self):
+        if self._pool is None:
+            return
+        for conn in self._connections:
+            conn.close()
+        self._connections.clear()
+        self._pool = None
+        self._executor.shutdown(wait=True)
+        self._executor = None
+
+    # Выполняет функцию с соединением из пула вне event loop
+    async def run(self, func: Callable[..., Any], *args, label: str = None) -> Any:
+        if self._pool is None:
+            await self.open()
+        conn = await self._pool.get()
+        start = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, func, conn, *args)
+        finally:
+            self._pool.put_nowait(conn)
+            if self.on_query:
+                self.on_query(query_name(label) if label else func.__name__.strip('_'), time.perf_counter() - start)
+
+    async def fetchone(self, sql: str, params: Sequence = ()) -> Optional[tuple]:
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone(), label=sql)
+
+    async def fetchall(self, sql: str, params: Sequence = ()) -> List[tuple]:
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall(), label=sql)
+
+    async def execute(self, sql: str, params: Sequence = ()) -> int:
+        def _execute(conn):
+            with conn:
+                return conn.execute(sql, params).rowcount
+        return await self.run(_execute, label=sql)
+
+    async def executemany(self, sql: str, rows: Iterable[Sequence]) -> int:
+        def _executemany(conn):
+            with conn:
+                return conn.executemany(sql, rows).rowcount
+        return await self.run(_executemany, label=sql)
+
+
+# Имя запроса для метрик: название константы или первое слово SQL
+def query_name(sql: str) -> str:
+    name = QUERY_NAMES.get(sql)
+    if name is None:
+        name = sql.split(None, 1)[0].upper() if sql.strip() else 'EMPTY'
+    return name
+
+
+QUERY_NAMES = {
+    value: name for name, value in list(globals().items())
+    if name.isupper() and isinstance(value, str) and name != 'SCHEMA'
+}
+
+db = Database('database.db')
+
+
+async def init():
+    await db.open()
+
+
+async def close():
+    await db.close()
+
+
+async def get_user_ids() -> List[int]:
+    return [row[0] for row in await db.fetchall(GET_USER_IDS)]
+
+
+async def upsert_users(rows: List[tuple]):
+    await db.executemany(UPSERT_USER, rows)
+
+
+async def get_users_page(after_id: int, limit: int) -> List[tuple]:
+    return await db.fetchall(GET_USERS_PAGE, (after_id, limit))
+
+
+async def get_products() -> List[tuple]:
+    return await db.fetchall(GET_PRODUCTS)
+
+
+async def get_product(product_id: int) -> Optional[tuple]:
+    return await db.fetchone(GET_PRODUCT, (product_id,))
+
+
+async def get_product_photos() -> List[tuple]:
+    return await db.fetchall(GET_PRODUCT_PHOTOS)
+
+
+async def set_product_photos(rows: List[tuple]):
+    await db.executemany(SET_PRODUCT_PHOTOS, rows)
+
+
+async def search_products(match: str, limit: int, candidates: int = 500) -> List[tuple]:
+    return await db.fetchall(SEARCH_PRODUCTS, (match, candidates, limit))
+
+
+async def get_catalog_version() -> int:
+    row = await db.fetchone(GET_CATALOG_VERSION)
+    return row[0] if row else 0
+
+
+# Атомарно закрепляет за владельцем до limit свободных кодов товара
+async def reserve_codes(product_id: int, owner: str, limit: int, now: int) -> List[tuple]:
+    def _reserve(conn):
+        with conn:
+            return conn.execute(RESERVE_CODES, (owner, now, product_id, limit)).fetchall()
+    return await db.run(_reserve)
+
+
+# Пакетная вставка кодов; дубликаты отсекает уникальный индекс. Возвращает число добавленных
+async def insert_codes(rows: List[tuple]) -> int:
+    return await db.executemany(INSERT_CODES, rows)
+
+
+async def insert_products(rows: List[tuple]) -> int:
+    return await db.executemany(INSERT_PRODUCTS, rows)
+
+
+async def get_product_ids() -> List[int]:
+    return [row[0] for row in await db.fetchall(GET_PRODUCT_IDS)]
+
+
+async def claim_codes(rows: List[tuple]):
+    await db.executemany(CLAIM_CODE, rows)
+
+
+# Возвращает в продажу перечисленные коды, если они всё ещё зарезервированы владельцем и не выданы
+async def release_codes(owner: str, rowids: List[int]) -> int:
+    return await db.executemany(RELEASE_CODES, [(rowid, owner) for rowid in rowids])
+
+
+# Снимает чужие резервы старше reserved_before: их владелец упал, не успев вернуть коды.
+# Коды, уже записанные в заказы, остаются за покупателями, даже если отметка о выдаче не записана
+async def reclaim_codes(owner: str, reserved_before: int) -> int:
+    return await db.execute(RECLAIM_CODES, (owner, reserved_before))
+
+
+# Число свободных кодов по товарам (по частичному индексу idx_products_code_free)
+async def count_free_codes() -> List[tuple]:
+    return await db.fetchall(COUNT_FREE_CODES)
+
+
+# Запись об оплате; False - такой платёж уже был обработан
+async def add_payment(charge_id: str, tg_id: int, product_id: int, amount: int) -> bool:
+    return await db.execute(ADD_PAYMENT, (charge_id, tg_id, product_id, amount)) == 1
+
+
+async def get_recent_payments(limit: int) -> List[str]:
+    return [row[0] for row in await db.fetchall(GET_RECENT_PAYMENTS, (limit,))]
+
+
+# Время записи платежа и заказ по нему (rowid и код; None, если заказ ещё не записан)
+async def get_payment_order(charge_id: str) -> Optional[tuple]:
+    return await db.fetchone(GET_PAYMENT_ORDER, (charge_id,))
+
+
+# Отмечает, что заказ по платежу восстанавливается; True только для первого вызова
+async def start_payment_recovery(charge_id: str) -> bool:
+    def _start(conn):
+        with conn:
+            return conn.execute(START_PAYMENT_RECOVERY, (charge_id,)).fetchone() is not None
+    return await db.run(_start, label=START_PAYMENT_RECOVERY)
+
+
+async def get_order_code(order_id: str) -> Optional[str]:
+    row = await db.fetchone(GET_ORDER_CODE, (order_id,))
+    return row[0] if row else None
+
+
+async def count_stale_reservations(owner: str) -> int:
+    row = await db.fetchone(COUNT_STALE_RESERVATIONS, (owner,))
+    return row[0]
+
+
+# Запись заказа вместе с отметкой о выдаче кода (claim - параметры CLAIM_CODE) в одной транзакции
+async def add_order(tg_id: int, product_id: int, order_id: str, status: str, amount: int,
+                    code: Optional[str], method: str, claim: Optional[tuple] = None):
+    def _add(conn):
+        with conn:
+            if claim:
+                conn.execute(CLAIM_CODE, claim)
+            conn.execute(ADD_ORDER, (tg_id, product_id, order_id, status, amount, code, method))
+    await db.run(_add, label=ADD_ORDER)
+
+
+async def add_sales_activity(rows: List[tuple]):
+    await db.executemany(ADD_SALES_ACTIVITY, rows)
+
+
+# Сводка по периодам из period_days дней начиная с дня since (номер дня от 1970-01-01)
+async def get_sales_by_period(since: int, period_days: int) -> List[tuple]:
+    shift = 3 if period_days == 7 else 0
+    return await db.fetchall(GET_SALES_BY_PERIOD, (shift, period_days, since))
+
+
+async def get_sales_by_product(since: int, limit: int) -> List[tuple]:
+    return await db.fetchall(GET_SALES_BY_PRODUCT, (since, limit))
+
+
+async def get_sales_page(after: tuple, limit: int) -> List[tuple]:
+    return await db.fetchall(GET_SALES_PAGE, (*after, limit))
+
+
+async def get_user_stats(tg_id: int) -> Optional[tuple]:
+    return await db.fetchone(GET_USER_STATS, (tg_id,))
+
+
+# Страница истории покупок, более старая чем (created_at, rowid)
+async def get_order_history(tg_id: int, before: tuple, limit: int) -> List[tuple]:
+    return await db.fetchall(GET_ORDER_HISTORY, (tg_id, *before, limit))
+
+
+async def put_pending_order(order_id: str, user_id: int, data: str, expires_at: float):
+    await db.execute(PUT_PENDING_ORDER, (order_id, user_id, data, expires_at))
+
+
+# Продлевает срок жизни заказа и возвращает его данные
+async def touch_pending_order(order_id: str, now: float, ttl: float) -> Optional[str]:
+    def _touch(conn):
+        with conn:
+            row = conn.execute(TOUCH_PENDING_ORDER, (now, ttl, order_id, now)).fetchone()
+        return row[0] if row else None
+    return await db.run(_touch)
+
+
+async def delete_pending_order(order_id: str):
+    await db.execute(DELETE_PENDING_ORDER, (order_id,))
+
+
+# Атомарно удаляет заказ и возвращает его данные: забрать заказ может только один обработчик
+async def take_pending_order(order_id: str, now: float) -> Optional[str]:
+    def _take(conn):
+        with conn:
+            row = conn.execute(TAKE_PENDING_ORDER, (order_id, now)).fetchone()
+        return row[0] if row else None
+    return await db.run(_take)
+
+
+async def purge_pending_orders(now: float, max_size: int) -> int:
+    return await db.execute(PURGE_PENDING_ORDERS, (now, max_size))
+
+
+async def get_media_cache() -> List[tuple]:
+    return await db.fetchall(GET_MEDIA_CACHE)
+
+
+async def put_media_cache(path: str, mtime_ns: int, size: int, file_id: str):
+    await db.execute(PUT_MEDIA_CACHE, (path, mtime_ns, size, file_id))
+
+
+async def delete_media_cache(path: str):
+    await db.execute(DELETE_MEDIA_CACHE, (path,))
+
+
+async def add_dead_letter(chat_id: int, method: str, payload: str, error: str):
+    await db.execute(ADD_DEAD_LETTER, (chat_id, method, payload, error))
+
+
+async def get_fsm(key: str) -> Optional[tuple]:
+    return await db.fetchone(GET_FSM, (key,))
+
+
+# updated_at по списку ключей; ключей без строки в ответе нет
+async def get_fsm_updated_at(keys: List[str]) -> Dict[str, float]:
+    return dict(await db.fetchall(GET_FSM_UPDATED_AT, (json.dumps(keys),)))
+
+
+# Сохраняет изменённые состояния FSM одной транзакцией
+async def save_fsm(upserts: List[tuple], deletes: List[tuple]):
+    def _save(conn):
+        with conn:
+            conn.executemany(PUT_FSM, upserts)
+            conn.executemany(DELETE_FSM, deletes)
+    await db.run(_save)
+
+
+async def purge_fsm(updated_before: float) -> int:
+    return await db.execute(PURGE_FSM, (updated_before,))
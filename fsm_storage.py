@@ -0,0 +1,203 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Set
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+import db
+from background import PeriodicFlusher, spawn
+
+logger = logging.getLogger(__name__)
+
+
+class _Record:
+    __slots__ = ('state', 'data', 'updated_at')
+
+    def __init__(self, state: Optional[str], data: Dict[str, Any], updated_at: float):
+        self.state = state
+        self.data = data
+        self.updated_at = updated_at
+
+
+# Хранилище FSM в SQLite с LRU-кэшем в памяти.
+# set_state/set_data возвращаются после записи в БД, одновременные изменения пишутся одной транзакцией.
+# Запись кэша сверяется с updated_at в БД, поэтому несколько процессов бота
+# (вебхук за балансировщиком) сразу видят изменения друг друга.
+# Состояния, не менявшиеся дольше ttl секунд, считаются сброшенными.
+# Неудавшиеся записи повторяются раз в flush_interval секунд, устаревшие строки удаляются раз в purge_interval секунд.
+class SQLiteStorage(BaseStorage):
+    def __init__(self, cache_size: int = 10000, ttl: float = 86400, flush_interval: float = 1.0,
+                 purge_interval: float = 3600):
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self._cache: "OrderedDict[str, _Record]" = OrderedDict()
+        self._dirty: Set[str] = set()
+        # Ключи, которые сейчас записываются в БД: до коммита в БД ещё старые значения
+        self._saving: Set[str] = set()
+        self._purged_at = 0.0
+        self._flusher = PeriodicFlusher(self._flush_and_purge, flush_interval, "fsm")
+        self._flush_lock = asyncio.Lock()
+        self._lookups: Dict[str, asyncio.Future] = {}
+        self._lookup_task: Optional[asyncio.Task] = None
+        self._write_waiter: Optional[asyncio.Future] = None
+        self._write_task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ":".join(str(part) for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny
+        ))
+
+    async def start(self):
+        await self.purge()
+        self._flusher.start()
+
+    async def purge(self):
+        self._purged_at = time.monotonic()
+        removed = await db.purge_fsm(time.time() - self.ttl)
+        if removed:
+            logger.info(f"Удалено устаревших состояний FSM: {removed}")
+
+    def _pending(self, key: str) -> bool:
+        return key in self._dirty or key in self._saving
+
+    async def _load(self, key: str) -> _Record:
+        record = self._cache.get(key)
+        now = time.time()
+        if record is not None and (self._pending(key) or await self._is_current(key, record)):
+            self._remember(key, record)
+        else:
+            row = await db.get_fsm(key)
+            if row and row[2] > now - self.ttl:
+                record = _Record(row[0], json.loads(row[1]), row[2])
+            else:
+                record = _Record(None, {}, now)
+            self._remember(key, record)
+
+        if record.updated_at <= now - self.ttl:
+            record.state, record.data = None, {}
+        return record
+
+    # Не изменил ли запись другой процесс: сверка с updated_at в БД
+    async def _is_current(self, key: str, record: _Record) -> bool:
+        updated_at = await self._updated_at(key)
+        if updated_at is None:
+            return record.state is None and not record.data
+        return updated_at == record.updated_at
+
+    # updated_at ключа из БД. Запрос в полёте один, а проверки, пришедшие за время его
+    # выполнения, уходят следующим запросом вместе. Запрос всегда начинается после вызова,
+    # поэтому видит все изменения, закоммиченные до него
+    async def _updated_at(self, key: str) -> Optional[float]:
+        future = self._lookups.get(key)
+        if future is None:
+            future = self._lookups[key] = asyncio.get_running_loop().create_future()
+            if self._lookup_task is None:
+                self._lookup_task = spawn(self._lookup_loop(), name="fsm_lookup")
+        return await asyncio.shield(future)
+
+    async def _lookup_loop(self):
+        try:
+            while self._lookups:
+                lookups, self._lookups = self._lookups, {}
+                try:
+                    found = await db.get_fsm_updated_at(list(lookups))
+                except Exception as e:
+                    for future in lookups.values():
+                        future.set_exception(e)
+                    continue
+                for key, future in lookups.items():
+                    future.set_result(found.get(key))
+        finally:
+            self._lookup_task = None
+
+    def _remember(self, key: str, record: _Record):
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        # Вытесняем самые старые записи; несохранённые дождутся ближайшего flush
+        while len(self._cache) > self.cache_size:
+            old_key = next(iter(self._cache))
+            if self._pending(old_key):
+                break
+            del self._cache[old_key]
+
+    # Следующий апдейт этого чата может достаться другому процессу, поэтому пишем в БД сразу
+    async def _touch(self, key: str, record: _Record):
+        record.updated_at = time.time()
+        self._dirty.add(key)
+        self._remember(key, record)
+        await self._write()
+
+    # Групповая запись: ждём ближайший flush, который начнётся после этого вызова.
+    # Изменения, накопленные за время текущей записи, уходят следующей транзакцией вместе
+    async def _write(self):
+        waiter = self._write_waiter
+        if waiter is None:
+            waiter = self._write_waiter = asyncio.get_running_loop().create_future()
+            if self._write_task is None:
+                self._write_task = spawn(self._write_loop(), name="fsm_write")
+        await asyncio.shield(waiter)
+
+    async def _write_loop(self):
+        try:
+            while self._write_waiter is not None:
+                waiter, self._write_waiter = self._write_waiter, None
+                # Если запись не удалась, ключи остаются в _dirty и повторяются фоново
+                await self.flush()
+                waiter.set_result(None)
+        finally:
+            self._write_task = None
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key = self._key(key)
+        record = await self._load(storage_key)
+        record.state = state.state if isinstance(state, State) else state
+        await self._touch(storage_key, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._load(self._key(key))).state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        storage_key = self._key(key)
+        record = await self._load(storage_key)
+        record.data = dict(data)
+        await self._touch(storage_key, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return dict((await self._load(self._key(key))).data)
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, set()
+            self._saving = dirty
+            records = {key: self._cache[key] for key in dirty}
+            upserts, deletes = [], []
+            for key, record in records.items():
+                if record.state is None and not record.data:
+                    deletes.append((key,))
+                else:
+                    upserts.append((key, record.state, json.dumps(record.data, ensure_ascii=False), record.updated_at))
+            try:
+                await db.save_fsm(upserts, deletes)
+            except Exception as e:
+                logger.error(f"Не удалось сохранить состояния FSM: {e}")
+                for key, record in records.items():
+                    self._cache.setdefault(key, record)
+                self._dirty |= dirty
+            finally:
+                self._saving = set()
+
+    async def _flush_and_purge(self):
+        await self.flush()
+        if time.monotonic() - self._purged_at >= self.purge_interval:
+            await self.purge()
+
+    async def close(self) -> None:
+        await self._flusher.stop()
@@ -0,0 +1,155 @@
+import codecs
+import csv
+import logging
+import time
+from dataclasses import dataclass
+from typing import AsyncIterator, Awaitable, Callable, List, Optional
+
+import db
+
+logger = logging.getLogger(__name__)
+
+MAX_CODE_LENGTH = 256
+# Дольше этого кавычку считаем незакрытой по ошибке и перестаём ждать конец записи
+MAX_RECORD_LENGTH = 1024 * 1024
+HEADER_NAMES = {'code', 'код', 'product_id', 'id_product'}
+
+
+# Счётчики одного импорта
+@dataclass
+class ImportStats:
+    rows: int = 0
+    inserted: int = 0
+    duplicates: int = 0
+    rejected: int = 0
+
+
+# Длина начала text из целых записей CSV: после последнего перевода строки вне кавычек
+def _records_end(text: str) -> int:
+    if '"' not in text:
+        return max(text.rfind('\n'), text.rfind('\r')) + 1
+    end = position = quotes = 0
+    for line in text.splitlines(keepends=True):
+        if not line.endswith(('\n', '\r')):
+            break
+        position += len(line)
+        quotes += line.count('"')
+        # Чётное число кавычек - все поля в кавычках закрыты (удвоенная кавычка чётность не меняет)
+        if quotes % 2 == 0:
+            end = position
+    return end
+
+
+# Строки CSV из потока байтов: файл целиком в памяти не держим.
+# Запись с переводом строки внутри поля в кавычках не разрывается на границе кусков
+async def iter_rows(chunks: AsyncIterator[bytes]) -> AsyncIterator[List[List[str]]]:
+    decoder = codecs.getincrementaldecoder('utf-8-sig')(errors='replace')
+    tail = ''
+    async for chunk in chunks:
+        text = tail + decoder.decode(chunk)
+        # \r в конце куска может оказаться началом \r\n
+        end = _records_end(text[:-1] if text.endswith('\r') else text)
+        if end == 0 and len(text) > MAX_RECORD_LENGTH:
+            end = max(text.rfind('\n'), text.rfind('\r')) + 1
+        tail = text[end:]
+        if end:
+            yield list(csv.reader(text[:end].splitlines(keepends=True)))
+    tail += decoder.decode(b'', final=True)
+    if tail:
+        yield list(csv.reader([tail]))
+
+
+async def _rows(chunks: AsyncIterator[bytes]) -> AsyncIterator[List[str]]:
+    async for rows in iter_rows(chunks):
+        for row in rows:
+            yield row
+
+
+# Импорт кодов. Строка файла - "код" (для product_id из команды) или "id_товара,код".
+# Вставка пачками по batch_size в отдельных транзакциях, дубликаты отсекает уникальный индекс.
+async def import_codes(chunks: AsyncIterator[bytes], product_id: Optional[int] = None,
+                       batch_size: int = 10000, progress_interval: float = 3.0,
+                       on_progress: Callable[[ImportStats], Awaitable[None]] = None) -> ImportStats:
+    stats = ImportStats()
+    product_ids = set(await db.get_product_ids())
+    batch = []
+    reported_at = time.monotonic()
+
+    async def flush():
+        inserted = await db.insert_codes(batch)
+        stats.inserted += inserted
+        stats.duplicates += len(batch) - inserted
+        batch.clear()
+
+    async for row in _rows(chunks):
+        row = [field.strip() for field in row]
+        if not any(row):
+            continue
+        stats.rows += 1
+        if stats.rows == 1 and row[0].lower() in HEADER_NAMES:
+            stats.rows = 0
+            continue
+        if len(row) == 1 and product_id is not None:
+            target, code = product_id, row[0]
+        elif len(row) == 2 and row[0].isdigit():
+            target, code = int(row[0]), row[1]
+        else:
+            stats.rejected += 1
+            continue
+        if target not in product_ids or not code or len(code) > MAX_CODE_LENGTH:
+            stats.rejected += 1
+            continue
+
+        batch.append((target, code))
+        if len(batch) >= batch_size:
+            await flush()
+            if on_progress and time.monotonic() - reported_at >= progress_interval:
+                reported_at = time.monotonic()
+                await on_progress(stats)
+    if batch:
+        await flush()
+    logger.info(f"Импорт кодов: строк {stats.rows}, добавлено {stats.inserted}, "
+                f"дубликатов {stats.duplicates}, отклонено {stats.rejected}")
+    return stats
+
+
+# Импорт товаров из CSV с заголовком name,description,price[,photo]
+async def import_products(chunks: AsyncIterator[bytes], batch_size: int = 1000, progress_interval: float = 3.0,
+                          on_progress: Callable[[ImportStats], Awaitable[None]] = None) -> ImportStats:
+    stats = ImportStats()
+    columns = None
+    batch = []
+    reported_at = time.monotonic()
+
+    async def flush():
+        inserted = await db.insert_products(batch)
+        stats.inserted += inserted
+        stats.duplicates += len(batch) - inserted
+        batch.clear()
+
+    async for row in _rows(chunks):
+        row = [field.strip() for field in row]
+        if not any(row):
+            continue
+        if columns is None:
+            columns = [name.lower() for name in row]
+            if not {'name', 'price'} <= set(columns):
+                raise ValueError("В первой строке нужен заголовок: name,description,price,photo")
+            continue
+        stats.rows += 1
+        values = dict(zip(columns, row))
+        if len(row) != len(columns) or not values['name'] or not values['price'].isdigit():
+            stats.rejected += 1
+            continue
+        batch.append((values['name'], values.get('description') or None, int(values['price']),
+                      values.get('photo') or None))
+        if len(batch) >= batch_size:
+            await flush()
+            if on_progress and time.monotonic() - reported_at >= progress_interval:
+                reported_at = time.monotonic()
+                await on_progress(stats)
+    if batch:
+        await flush()
+    logger.info(f"Импорт товаров: строк {stats.rows}, добавлено {stats.inserted}, "
+                f"дубликатов {stats.duplicates}, отклонено {stats.rejected}")
+    return stats
@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import time
+import uuid
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+import db
+from background import PeriodicFlusher
+
+logger = logging.getLogger(__name__)
+
+
+# Выдача кодов: каждый код достаётся ровно одному покупателю.
+# Коды резервируются пачками за процессом. Отметка о выдаче пишется вместе с заказом
+# (reserve + claim_mark), а если заказ не записан - фоново (claim, mark_claimed).
+# Остатки по товарам считаются в памяти и сверяются с БД раз в stock_interval секунд.
+# Резерв действует lease секунд: при запуске резервы упавших процессов старше срока снимаются,
+# а свои резервы старше половины срока процесс возвращает в продажу и резервирует коды заново.
+class Inventory:
+    def __init__(self, batch_size: int = 5, flush_interval: float = 0.5, stock_interval: float = 10.0,
+                 lease: float = 3600.0):
+        self.owner = uuid.uuid4().hex
+        self.batch_size = batch_size
+        self.stock_interval = stock_interval
+        self.lease = lease
+        self._free: Dict[int, int] = {}
+        self._stock_checked_at = 0.0
+        self._reserved: Dict[int, Deque[Tuple[int, str, int]]] = {}
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._issued: List[tuple] = []
+        self._flusher = PeriodicFlusher(self._flush_and_refresh, flush_interval, "inventory")
+
+    async def start(self):
+        reclaimed = await db.reclaim_codes(self.owner, int(time.time() - self.lease))
+        if reclaimed:
+            logger.warning(f"Возвращено в продажу кодов с просроченным резервом: {reclaimed}")
+        stale = await db.count_stale_reservations(self.owner)
+        if stale:
+            logger.warning(f"В БД есть {stale} кодов, зарезервированных другими процессами")
+        await self.refresh_stock()
+        self._flusher.start()
+
+    async def stop(self):
+        await self._flusher.stop()
+        if self._issued:
+            logger.error(f"Не записаны отметки о выдаче {len(self._issued)} кодов, их резерв остаётся в БД")
+        # Возвращаем только не выданные коды: выданные, но не записанные, остаются в резерве
+        rowids = [item[0] for reserved in self._reserved.values() for item in reserved]
+        released = await db.release_codes(self.owner, rowids) if rowids else 0
+        self._reserved.clear()
+        logger.info(f"Возвращено в продажу неиспользованных кодов: {released}")
+
+    # Забирает код товара для покупателя с фоновой записью отметки, None если коды закончились
+    async def claim(self, product_id: int, tg_id: int) -> Optional[str]:
+        reserved = await self.reserve(product_id)
+        if reserved is None:
+            return None
+        self.mark_claimed(self.claim_mark(reserved[0], tg_id))
+        return reserved[1]
+
+    # Снимает с резерва процесса следующий код товара: (rowid, код) или None.
+    # Код нужно отметить выданным - в транзакции заказа (claim_mark) или фоново (mark_claimed)
+    async def reserve(self, product_id: int) -> Optional[Tuple[int, str]]:
+        lock = self._locks.setdefault(product_id, asyncio.Lock())
+        async with lock:
+            reserved = self._reserved.setdefault(product_id, deque())
+            now = int(time.time())
+            # Резерв, который скоро истечёт, может забрать другой процесс: возвращаем его в продажу
+            expired = []
+            while reserved and reserved[0][2] < now - self.lease / 2:
+                expired.append(reserved.popleft()[0])
+            if expired:
+                released = await db.release_codes(self.owner, expired)
+                self._free[product_id] = self._free.get(product_id, 0) + released
+            if not reserved:
+                rows = await db.reserve_codes(product_id, self.owner, self.batch_size, now)
+                reserved.extend((rowid, code, now) for rowid, code in rows)
+                self._free[product_id] = max(0, self._free.get(product_id, 0) - len(rows))
+            if not reserved:
+                return None
+            rowid, code, _ = reserved.popleft()
+        return rowid, code
+
+    # Возвращает в продажу код, взятый reserve, но так и не отданный покупателю
+    async def release(self, product_id: int, rowid: int):
+        released = await db.release_codes(self.owner, [rowid])
+        self._free[product_id] = self._free.get(product_id, 0) + released
+
+    # Параметры CLAIM_CODE для отметки о выдаче кода
+    def claim_mark(self, rowid: int, tg_id: int) -> tuple:
+        return tg_id, int(time.time()), rowid, self.owner
+
+    def mark_claimed(self, mark: tuple):
+        self._issued.append(mark)
+
+    # Сколько кодов товара ещё можно выдать: свободные в БД и зарезервированные этим процессом
+    def stock(self, product_id: int) -> int:
+        return self._free.get(product_id, 0) + len(self._reserved.get(product_id, ()))
+
+    async def refresh_stock(self):
+        self._free = dict(await db.count_free_codes())
+        self._stock_checked_at = time.monotonic()
+
+    async def flush(self):
+        if not self._issued:
+            return
+        issued, self._issued = self._issued, []
+        try:
+            await db.claim_codes(issued)
+        except Exception as e:
+            logger.error(f"Не удалось записать выданные коды: {e}")
+            self._issued = issued + self._issued
+
+    async def _flush_and_refresh(self):
+        await self.flush()
+        if time.monotonic() - self._stock_checked_at >= self.stock_interval:
+            await self.refresh_stock()
@@ -1,5 +1,20 @@
+from functools import lru_cache
+
+from aiogram.filters.callback_data import CallbackData
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton
 
+# Кнопки товара: действие, id товара и версия каталога на момент показа
+class ProductCallback(CallbackData, prefix="product"):
+    action: str
+    product_id: int
+    version: int
+
+# Кнопки листания сетки каталога
+class CatalogPageCallback(CallbackData, prefix="catalog"):
+    page: int
+
+# Клавиатуры без параметров создаются один раз и переиспользуются, поэтому изменять их нельзя
+@lru_cache(maxsize=None)
 def get_payment_confirmation_keyboard():
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="✅ Я оплатил", callback_data="confirm_payment")],
@@ -7,6 +22,7 @@ def get_payment_confirmation_keyboard():
     ])
     return keyboard
 
+@lru_cache(maxsize=None)
 def get_payment_method_keyboard():
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="💳 Оплатить онлайн", callback_data="pay_online")],
@@ -15,22 +31,57 @@ def get_payment_method_keyboard():
     ])
     return keyboard
 
+@lru_cache(maxsize=None)
 def get_main_menu():
     buttons = [
-        [KeyboardButton(text="📦 Товары")],
+        [KeyboardButton(text="📦 Товары"), KeyboardButton(text="📋 Каталог")],
         [KeyboardButton(text="👤 Личный кабинет")]
     ]
     return ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
 
+@lru_cache(maxsize=None)
 def remove_menu():
     return ReplyKeyboardRemove()
 
-def get_product_nav(current_index, total_products):
+# Кнопки товара общие для всех показов этого товара в одной версии каталога
+@lru_cache(maxsize=4096)
+def get_product_nav(product_id, version):
     buttons = [
         [
-            InlineKeyboardButton(text="⬅️", callback_data=f"prev_{current_index}"),
-            InlineKeyboardButton(text="🛒 Купить", callback_data=f"buy_{current_index}"),
-            InlineKeyboardButton(text="➡️", callback_data=f"next_{current_index}")
+            InlineKeyboardButton(text="⬅️", callback_data=ProductCallback(action="prev", product_id=product_id, version=version).pack()),
+            InlineKeyboardButton(text="🛒 Купить", callback_data=ProductCallback(action="buy", product_id=product_id, version=version).pack()),
+            InlineKeyboardButton(text="➡️", callback_data=ProductCallback(action="next", product_id=product_id, version=version).pack())
         ]
     ]
-    return InlineKeyboardMarkup(inline_keyboard=buttons)
\ No newline at end of file
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+@lru_cache(maxsize=None)
+def get_profile_keyboard():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🧾 История покупок", callback_data="history")]
+    ])
+
+def get_history_nav(created_at, rowid):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="➡️ Ранее", callback_data=f"history_{created_at}_{rowid}")]
+    ])
+
+def get_catalog_grid(products, page, pages, version):
+    buttons = [
+        [InlineKeyboardButton(text=f"{product[1]} — {product[3]} руб.", callback_data=ProductCallback(action="open", product_id=product[0], version=version).pack())]
+        for product in products
+    ]
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton(text="⬅️", callback_data=CatalogPageCallback(page=page - 1).pack()))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton(text="➡️", callback_data=CatalogPageCallback(page=page + 1).pack()))
+    if nav:
+        buttons.append(nav)
+    buttons.append([InlineKeyboardButton(text="🔎 Поиск", switch_inline_query_current_chat="")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+def get_open_in_bot_keyboard(url):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🛒 Открыть в боте", url=url)]
+    ])
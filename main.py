@@ -1,15 +1,40 @@
+import asyncio
 import logging
 import sqlite3
 import os
-from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import Command
-from aiogram.types import Message, InputFile, CallbackQuery, LabeledPrice
+import time
+from datetime import datetime
+from aiogram import Bot, Dispatcher, types, F, html
+from aiogram.filters import Command, CommandObject
+from aiogram.types import Message, InputFile, CallbackQuery, LabeledPrice, InputMediaPhoto, \
+    InlineQueryResultArticle, InlineQueryResultCachedPhoto, InputTextMessageContent
 from aiogram.enums import ParseMode
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from keyboards import get_main_menu, remove_menu, get_product_nav, get_payment_confirmation_keyboard, \
-    get_payment_method_keyboard
-from typing import Dict
+from keyboards import get_main_menu, remove_menu, get_payment_confirmation_keyboard, \
+    get_payment_method_keyboard, get_profile_keyboard, get_history_nav, ProductCallback, CatalogPageCallback, \
+    get_catalog_grid, get_open_in_bot_keyboard
+from catalog import CatalogCache
+from search import ProductSearch
+import db
+from inventory import Inventory
+from order_store import create_order_store
+from media import MediaCache, is_file_error
+from photos import prepare_photos, read_file
+from importer import ImportStats, import_codes, import_products
+from analytics import SalesCounters, SalesCsvFile, format_day, today
+from render import ProductRenderCache, RenderSession
+from notifier import Notifier
+from users import UserRegistry
+from payments import PaymentRegistry
+from throttling import ThrottlingMiddleware, parse_limit
+from fsm_storage import SQLiteStorage
+from background import spawn
+from metrics import metrics, UpdateMetricsMiddleware, HandlerMetricsMiddleware, observe_query, \
+    start_metrics_server, summary
+from aiogram.methods import SendMessage, SendPhoto
+from aiogram.exceptions import TelegramBadRequest
+from typing import Dict, Optional, Tuple
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -26,7 +51,12 @@ class PaymentStates(StatesGroup):
 
 # загрузка конфигурации
 def load_config():
-    config = {'BOT_TOKEN': '', 'ADMINS': [], 'PAYMENT_DETAILS': ''}
+    config = {'BOT_TOKEN': '', 'ADMINS': [], 'PAYMENT_DETAILS': '',
+              'ORDER_STORE': 'sqlite', 'ORDER_TTL': '86400', 'ORDER_MAX': '10000', 'REDIS_URL': '',
+              'MODE': 'polling', 'WEBHOOK_URL': '', 'WEBHOOK_PATH': '/webhook', 'WEBHOOK_SECRET': '',
+              'WEBHOOK_HOST': '0.0.0.0', 'WEBHOOK_PORT': '8080', 'WEBHOOK_GRACE': '5', 'FSM_STORAGE': 'sqlite',
+              'METRICS_HOST': '127.0.0.1', 'METRICS_PORT': '', 'MEDIA_URL': '',
+              'THROTTLE_START': '0.2:3', 'THROTTLE_NAV': '3:6', 'THROTTLE_BUY': '0.5:3'}
     try:
         with open('config.txt', 'r', encoding='utf-8') as file:
             for line in file:
@@ -38,6 +68,10 @@ def load_config():
                     config['ADMINS'] = [int(admin_id.strip()) for admin_id in admins if admin_id.strip().isdigit()]
                 elif line.startswith('PAYMENT_DETAILS='):
                     config['PAYMENT_DETAILS'] = line.split('=')[1].strip()
+                elif '=' in line:
+                    key, value = line.split('=', 1)
+                    if key.strip() in config:
+                        config[key.strip()] = value.strip()
     except FileNotFoundError:
         logger.error("Файл config.txt не найден!")
         raise
@@ -60,106 +94,320 @@ except Exception as e:
     logger.critical(f"Не удалось загрузить конфигурацию: {e}")
     exit(1)
 
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
+bot = Bot(token=BOT_TOKEN, session=RenderSession())
+dp = Dispatcher(storage=SQLiteStorage() if config['FSM_STORAGE'] == 'sqlite' else None)
 
-# Хранилище временных данных о заказах
-pending_orders: Dict[int, Dict] = {}
+# Лимиты частоты апдейтов на пользователя: "в секунду:запас" для /start, листания и покупки
+throttling = ThrottlingMiddleware({
+    'start': parse_limit(config['THROTTLE_START']),
+    'nav': parse_limit(config['THROTTLE_NAV']),
+    'buy': parse_limit(config['THROTTLE_BUY']),
+})
+dp.message.middleware(throttling)
+dp.callback_query.middleware(throttling)
 
+# Метрики: время апдейтов и хендлеров, вызовов Bot API и SQL-запросов
+dp.update.outer_middleware(UpdateMetricsMiddleware())
+for observer in (dp.message, dp.callback_query, dp.pre_checkout_query, dp.inline_query):
+    observer.middleware(HandlerMetricsMiddleware())
+db.db.on_query = observe_query
 
-# Получение товаров из бд
-def get_products():
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, name, description, price, photo FROM products")
-    products = cursor.fetchall()
-    conn.close()
-    return products
+# Хранилище незавершённых заказов
+orders = create_order_store(
+    config['ORDER_STORE'], int(config['ORDER_TTL']), int(config['ORDER_MAX']), config['REDIS_URL']
+)
+
+
+# Кэш товаров из бд
+catalog = CatalogCache()
+
+# Готовые карточки товаров для текущей версии каталога
+product_cards = ProductRenderCache(catalog)
+
+# Поиск по каталогу для inline-режима
+search = ProductSearch(catalog)
+
+# Выдача кодов товаров
+inventory = Inventory()
+
+# file_id уже загруженных фото товаров
+media = MediaCache()
+
+# Очередь уведомлений и рассылок
+notifier = Notifier(bot)
+
+# Регистрация пользователей с пакетной записью
+users = UserRegistry()
+
+# Обработанные онлайн-платежи
+payments = PaymentRegistry()
+
+# Просмотры и начатые покупки для отчёта о продажах
+sales = SalesCounters()
+
+
+def collect_metrics():
+    for name, value in catalog.stats().items():
+        metrics.gauge(f'catalog_cache_{name}', value)
+    metrics.gauge('render_cache_hits', product_cards.hits)
+    metrics.gauge('render_cache_misses', product_cards.misses)
+    if isinstance(bot.session, RenderSession):
+        metrics.gauge('markup_json_hits', bot.session.markup_hits)
+        metrics.gauge('markup_json_misses', bot.session.markup_misses)
+    metrics.gauge('search_cache_hits', search.hits)
+    metrics.gauge('search_cache_misses', search.misses)
+    metrics.gauge('media_cache_hits', media.hits)
+    metrics.gauge('media_cache_misses', media.misses)
+    metrics.gauge('notifier_sent', notifier.sent)
+    metrics.gauge('notifier_dead_letters', notifier.dead)
+    metrics.gauge('payments_duplicates', payments.duplicates)
+
+
+metrics.collectors.append(collect_metrics)
+
+# Задержка, за которую склеиваются частые нажатия ⬅️/➡️ в одном чате
+NAV_DEBOUNCE = 0.3
+# Последний запрошенный товар в чате: chat_id -> (номер нажатия, id товара)
+nav_requests: Dict[int, Tuple[int, int]] = {}
+
+# Товаров на одной странице сетки каталога
+CATALOG_PAGE_SIZE = 10
+# Сколько секунд Telegram может держать у себя ответ на inline-запрос
+INLINE_CACHE_TIME = 60
+# Через сколько секунд платёж без записанного заказа считается прерванным, а не обрабатываемым
+PAYMENT_RECOVERY_DELAY = 60
+
+
+# Текущий заказ пользователя из данных FSM
+async def get_current_order(state: FSMContext):
+    order_id = (await state.get_data()).get('order_id')
+    return await orders.get(order_id) if order_id else None
 
 
 # Выдача доступных товаров
-async def show_product(message: types.Message, product_index: int = 0):
-    products = get_products()
-    if not products:
+async def show_product(message: types.Message, product_id: int = None):
+    product = await catalog.get_by_id(product_id) if product_id else await catalog.get_first()
+    if not product:
         await message.answer("Товары отсутствуют", reply_markup=get_main_menu())
         return
+    sales.view(product[0])
+    await send_product(message, product)
 
-    product_index = product_index % len(products)
-    product = products[product_index]
 
-    caption = (
-        f"📛 <b>{product[1]}</b>\n\n"
-        f"📝 <i>{product[2]}</i>\n\n"
-        f"💰 Цена: <b>{product[3]} руб.</b>\n"
-        f"🆔 ID: {product[0]}"
-    )
+# Отправка карточки товара новым сообщением
+async def send_product(message: types.Message, product):
+    caption, reply_markup = await product_cards.get(product)
 
     photo_path = product[4] if len(product) > 4 else None
 
     if photo_path and os.path.exists(photo_path):
-        try:
-            with open(photo_path, 'rb') as photo_file:
+        file_id = media.get(photo_path)
+        if file_id:
+            try:
                 await message.answer_photo(
-                    types.BufferedInputFile(photo_file.read(), filename="product.jpg"),
+                    file_id,
                     caption=caption,
-                    reply_markup=get_product_nav(product_index, len(products)),
+                    reply_markup=reply_markup,
                     parse_mode=ParseMode.HTML
                 )
                 return
+            except TelegramBadRequest as e:
+                logger.warning(f"Не удалось отправить фото {photo_path} по file_id: {e}")
+                if is_file_error(e):
+                    await media.forget(photo_path)
+
+        try:
+            with metrics.timer('photo_read_seconds'):
+                photo = types.BufferedInputFile(await read_file(photo_path), filename="product.jpg")
+            sent = await message.answer_photo(
+                photo,
+                caption=caption,
+                reply_markup=reply_markup,
+                parse_mode=ParseMode.HTML
+            )
+            await media.remember(photo_path, sent.photo[-1].file_id)
+            return
         except Exception as e:
             logger.error(f"Ошибка при загрузке фото: {e}")
 
     await message.answer(
         text=caption,
-        reply_markup=get_product_nav(product_index, len(products)),
+        reply_markup=reply_markup,
         parse_mode=ParseMode.HTML
     )
 
 
+# Выдача кода и запись заказа в историю покупок.
+# Отметка о выдаче кода пишется в одной транзакции с заказом, чтобы проданный код не вернулся в продажу
+async def complete_order(order_info, status: str, method: str) -> str:
+    reserved = None
+    try:
+        reserved = await inventory.reserve(order_info['product_id'])
+        code = reserved[1] if reserved else "Код не найден. Пожалуйста, свяжитесь с поддержкой."
+
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при работе с БД: {e}")
+        code = "Ошибка получения кода. Пожалуйста, свяжитесь с поддержкой."
+
+    claim = inventory.claim_mark(reserved[0], order_info['user_id']) if reserved else None
+    try:
+        await db.add_order(order_info['user_id'], order_info['product_id'], order_info['order_id'],
+                           status, order_info['price'], reserved[1] if reserved else None, method, claim)
+    except sqlite3.IntegrityError:
+        # Заказ уже записал другой обработчик того же платежа: его код и отдаём, а свой возвращаем в продажу
+        logger.warning(f"Заказ {order_info['order_id']} уже записан, выдаём записанный код")
+        try:
+            if reserved:
+                await inventory.release(order_info['product_id'], reserved[0])
+            code = await db.get_order_code(order_info['order_id']) or "Код не найден. Пожалуйста, свяжитесь с поддержкой."
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка при работе с БД: {e}")
+            code = "Ошибка получения кода. Пожалуйста, свяжитесь с поддержкой."
+    except sqlite3.Error as e:
+        logger.error(f"Не удалось записать заказ {order_info['order_id']} в историю: {e}")
+        # Код уже отдан покупателю: отметку о выдаче допишем фоново
+        if claim:
+            inventory.mark_claimed(claim)
+    return code
+
+
+# Замена товара в уже отправленном сообщении
+async def edit_product(message: types.Message, product_id: int):
+    product = await catalog.get_by_id(product_id)
+    if not product:
+        await show_product(message)
+        return
+    sales.view(product[0])
+
+    caption, reply_markup = await product_cards.get(product)
+    photo_path = product[4] if len(product) > 4 else None
+    has_photo = bool(photo_path and os.path.exists(photo_path))
+
+    try:
+        if has_photo and message.photo:
+            file_id = media.get(photo_path)
+            if file_id:
+                photo = file_id
+            else:
+                with metrics.timer('photo_read_seconds'):
+                    photo = types.BufferedInputFile(await read_file(photo_path), filename="product.jpg")
+            edited = await message.edit_media(
+                InputMediaPhoto(media=photo, caption=caption, parse_mode=ParseMode.HTML),
+                reply_markup=reply_markup
+            )
+            if not file_id and isinstance(edited, Message) and edited.photo:
+                await media.remember(photo_path, edited.photo[-1].file_id)
+            return
+        if not has_photo and message.text:
+            await message.edit_text(caption, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+            return
+    except TelegramBadRequest as e:
+        if "message is not modified" in str(e):
+            return
+        logger.warning(f"Не удалось изменить сообщение с товаром: {e}")
+        # Ошибки вроде "message to edit not found" к файлу отношения не имеют
+        if has_photo and is_file_error(e):
+            await media.forget(photo_path)
+
+    # Сообщение нельзя перевести между фото и текстом, поэтому отправляем новое
+    await send_product(message, product)
+
+
 # Авторизация администратора
 async def is_admin(user_id: int):
     return user_id in ADMINS
 
 
 # Регистрация пользователя
-@dp.message(Command("start"))
-async def cmd_start(message: Message):
+@dp.message(Command("start"), flags={"throttle": "start"})
+async def cmd_start(message: Message, command: CommandObject):
     user_name = message.from_user.full_name
     user_id = message.from_user.id
     username = message.from_user.username
-    try:
-        conn = sqlite3.connect('database.db')
-        cursor = conn.cursor()
-
-        cursor.execute("SELECT tg_id FROM users WHERE tg_id = ?", (user_id,))
-        existing_user = cursor.fetchone()
-
-        if not existing_user:
-            cursor.execute(
-                "INSERT INTO users (tg_id, username, full_name) VALUES (?, ?, ?)",
-                (user_id, username, user_name)
-            )
-            conn.commit()
-            logger.info(f"Добавлен новый пользователь: {user_name} (ID: {user_id})")
-        else:
-            logger.info(f"Пользователь уже существует: {user_name} (ID: {user_id})")
-
-    except sqlite3.Error as e:
-        logger.error(f"Ошибка при работе с БД: {e}")
-    finally:
-        conn.close()
+    if users.register(user_id, username, user_name):
+        logger.info(f"Добавлен новый пользователь: {user_name} (ID: {user_id})")
+    else:
+        logger.info(f"Пользователь уже существует: {user_name} (ID: {user_id})")
 
     await message.answer(
         f"Привет, {user_name}! 👋\n\nДобро пожаловать в наш магазин.",
         reply_markup=get_main_menu()
     )
 
+    # Переход из inline-поиска: /start product_<id>
+    if command.args and command.args.startswith("product_") and command.args[8:].isdigit():
+        await show_product(message, int(command.args[8:]))
+
 
-@dp.message(F.text == "📦 Товары")
+@dp.message(F.text == "📦 Товары", flags={"throttle": "nav"})
 async def handle_products(message: Message):
     await show_product(message)
 
 
+# Сетка каталога: несколько товаров в одном сообщении
+async def render_catalog_page(page: int):
+    products, pages = await catalog.get_page(page, CATALOG_PAGE_SIZE)
+    page = min(max(page, 0), pages - 1)
+    if not products:
+        return "Товары отсутствуют", None
+    text = f"📋 Каталог (страница {page + 1} из {pages})\n\nВыберите товар или воспользуйтесь поиском:"
+    return text, get_catalog_grid(products, page, pages, await catalog.get_version())
+
+
+@dp.message(F.text == "📋 Каталог", flags={"throttle": "nav"})
+async def handle_catalog(message: Message):
+    text, reply_markup = await render_catalog_page(0)
+    await message.answer(text, reply_markup=reply_markup or get_main_menu())
+
+
+@dp.callback_query(CatalogPageCallback.filter(), flags={"throttle": "nav"})
+async def handle_catalog_page(callback: types.CallbackQuery, callback_data: CatalogPageCallback):
+    text, reply_markup = await render_catalog_page(callback_data.page)
+    try:
+        await callback.message.edit_text(text, reply_markup=reply_markup)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            raise
+    await callback.answer()
+
+
+@dp.callback_query(ProductCallback.filter(F.action == "open"), flags={"throttle": "nav"})
+async def handle_open_product(callback: types.CallbackQuery, callback_data: ProductCallback):
+    if not await catalog.get_by_id(callback_data.product_id):
+        await callback.answer("Товар больше недоступен")
+        return
+    await callback.answer()
+    await show_product(callback.message, callback_data.product_id)
+
+
+# Поиск товаров по названию и описанию: @бот запрос
+@dp.inline_query()
+async def handle_inline_search(inline_query: types.InlineQuery):
+    products = await search.search(inline_query.query)
+    me = await bot.me()
+    results = []
+    for product in products:
+        caption, _ = await product_cards.get(product)
+        reply_markup = get_open_in_bot_keyboard(f"https://t.me/{me.username}?start=product_{product[0]}")
+        file_id = media.get(product[4]) if product[4] else None
+        if file_id:
+            results.append(InlineQueryResultCachedPhoto(
+                id=str(product[0]), photo_file_id=file_id, title=product[1],
+                caption=caption, parse_mode=ParseMode.HTML, reply_markup=reply_markup
+            ))
+        else:
+            # Миниатюру Telegram скачивает сам, поэтому нужна публичная ссылка на папку media
+            thumbnail_url = None
+            if config['MEDIA_URL'] and len(product) > 5 and product[5]:
+                thumbnail_url = f"{config['MEDIA_URL'].rstrip('/')}/{os.path.basename(product[5])}"
+            results.append(InlineQueryResultArticle(
+                id=str(product[0]), title=product[1], description=f"{product[3]} руб. · {product[2]}",
+                input_message_content=InputTextMessageContent(message_text=caption, parse_mode=ParseMode.HTML),
+                reply_markup=reply_markup, thumbnail_url=thumbnail_url
+            ))
+    await inline_query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=False)
+
+
 @dp.message(F.text == "👤 Личный кабинет")
 async def handle_profile(message: Message):
     user = message.from_user
@@ -169,54 +417,115 @@ async def handle_profile(message: Message):
         f"Username: @{user.username if user.username else 'не указан'}\n"
         f"ID: {user.id}"
     )
-    await message.answer(profile_text, reply_markup=get_main_menu())
+    stats = await db.get_user_stats(user.id)
+    if not stats:
+        await message.answer(profile_text, reply_markup=get_main_menu())
+        return
 
+    profile_text += (
+        f"\n\n🛍 Покупок: {stats[0]}\n"
+        f"💰 Потрачено: {stats[1]} руб."
+    )
+    await message.answer(profile_text, reply_markup=get_profile_keyboard())
 
-# Система пролистования товаров
-@dp.callback_query(F.data.startswith("prev_") | F.data.startswith("next_"))
-async def handle_product_nav(callback: types.CallbackQuery):
-    action, index = callback.data.split("_")
-    index = int(index)
-    products = get_products()
 
-    if not products:
-        await callback.answer("Товары отсутствуют")
+# Размер страницы истории покупок
+HISTORY_PAGE_SIZE = 5
+ORDER_STATUSES = {'paid': '✅ оплачен', 'confirmed': '✅ подтверждён', 'rejected': '❌ отклонён'}
+
+
+# История покупок с постраничным листанием
+@dp.callback_query(F.data.startswith("history"))
+async def handle_history(callback: types.CallbackQuery):
+    if callback.data == "history":
+        before = (2 ** 62, 2 ** 62)
+    else:
+        _, created_at, rowid = callback.data.split("_")
+        before = (int(created_at), int(rowid))
+
+    rows = await db.get_order_history(callback.from_user.id, before, HISTORY_PAGE_SIZE + 1)
+    if not rows:
+        await callback.answer("Покупок больше нет")
         return
 
-    if action == "prev":
-        new_index = (index - 1) % len(products)
-    elif action == "next":
-        new_index = (index + 1) % len(products)
+    page = rows[:HISTORY_PAGE_SIZE]
+    lines = ["🧾 <b>История покупок</b>\n"]
+    for rowid, created_at, status, amount, code, product_name in page:
+        date = datetime.fromtimestamp(created_at).strftime('%d.%m.%Y %H:%M') if created_at else '—'
+        lines.append(
+            f"📦 {html.quote(product_name or 'Товар удалён')} — {amount or 0} руб.\n"
+            f"🕒 {date}, {ORDER_STATUSES.get(status, status or '—')}"
+            + (f"\n🔑 <code>{html.quote(code)}</code>" if code else "")
+        )
+    reply_markup = get_history_nav(page[-1][1], page[-1][0]) if len(rows) > HISTORY_PAGE_SIZE else None
+
+    if callback.data == "history":
+        await callback.message.answer("\n\n".join(lines), reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+    else:
+        await callback.message.edit_text("\n\n".join(lines), reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+    await callback.answer()
 
-    try:
-        await callback.message.edit_media()
-    except:
-        pass
 
-    await show_product(callback.message, new_index)
+# Система пролистования товаров
+@dp.callback_query(ProductCallback.filter(F.action.in_({"prev", "next"})), flags={"throttle": "nav"})
+async def handle_product_nav(callback: types.CallbackQuery, callback_data: ProductCallback):
+    # Пока предыдущее нажатие ждёт отрисовки, листаем от него, а не от кнопки
+    chat_id = callback.message.chat.id
+    ticket, pending_id = nav_requests.get(chat_id, (0, callback_data.product_id))
+    neighbors = await catalog.get_neighbors(pending_id)
+
+    if neighbors:
+        new_id = neighbors[0] if callback_data.action == "prev" else neighbors[1]
+    else:
+        product = await catalog.get_first()
+        if not product:
+            await callback.answer("Товары отсутствуют")
+            return
+        new_id = product[0]
+
+    ticket += 1
+    nav_requests[chat_id] = (ticket, new_id)
     await callback.answer()
 
+    await asyncio.sleep(NAV_DEBOUNCE)
+    if nav_requests.get(chat_id, (None,))[0] != ticket:
+        return
+    del nav_requests[chat_id]
+
+    await edit_product(callback.message, new_id)
+
 
 # Покупка товара и выбор способа оплаты
-@dp.callback_query(F.data.startswith("buy_"))
-async def handle_buy_product(callback: types.CallbackQuery, state: FSMContext):
-    product_index = int(callback.data.split("_")[1])
-    products = get_products()
+@dp.callback_query(ProductCallback.filter(F.action == "buy"), flags={"throttle": "buy"})
+async def handle_buy_product(callback: types.CallbackQuery, callback_data: ProductCallback, state: FSMContext):
+    product = await catalog.get_by_id(callback_data.product_id)
 
-    if not products:
-        await callback.answer("Товары отсутствуют")
+    if not product:
+        await callback.answer("Товар больше недоступен")
+        return
+
+    # Каталог изменился после показа товара: показываем актуальные данные перед оплатой
+    if callback_data.version != await catalog.get_version():
+        await callback.answer("Информация о товаре обновилась. Проверьте её и нажмите «Купить» ещё раз.",
+                              show_alert=True)
+        await edit_product(callback.message, product[0])
+        return
+
+    if inventory.stock(product[0]) <= 0:
+        await callback.answer("К сожалению, этот товар закончился.", show_alert=True)
         return
 
-    product = products[product_index % len(products)]
     user_id = callback.from_user.id
 
-    pending_orders[user_id] = {
+    order_id = await orders.create(user_id, {
         'product_id': product[0],
         'product_name': product[1],
         'price': product[3],
         'username': callback.from_user.username,
         'full_name': callback.from_user.full_name
-    }
+    })
+    await state.update_data(order_id=order_id)
+    sales.checkout(product[0])
 
     await callback.message.answer(
         "Выберите способ оплаты:",
@@ -229,8 +538,7 @@ async def handle_buy_product(callback: types.CallbackQuery, state: FSMContext):
 # Оплата через администратора
 @dp.callback_query(PaymentStates.SELECTING_PAYMENT_METHOD, F.data == "pay_admin")
 async def handle_admin_payment(callback: types.CallbackQuery, state: FSMContext):
-    user_id = callback.from_user.id
-    order_info = pending_orders.get(user_id)
+    order_info = await get_current_order(state)
 
     if not order_info:
         await callback.answer("Произошла ошибка. Пожалуйста, попробуйте оформить заказ снова.")
@@ -258,7 +566,7 @@ async def handle_admin_payment(callback: types.CallbackQuery, state: FSMContext)
 @dp.callback_query(PaymentStates.SELECTING_PAYMENT_METHOD, F.data == "pay_online")
 async def handle_online_payment(callback: types.CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
-    order_info = pending_orders.get(user_id)
+    order_info = await get_current_order(state)
 
     if not order_info:
         await callback.answer("Произошла ошибка. Пожалуйста, попробуйте оформить заказ снова.")
@@ -291,39 +599,98 @@ async def handle_online_payment(callback: types.CallbackQuery, state: FSMContext
     await callback.answer()
 
 
-# Проверка оплаты
+# Покупатель и товар из payload счёта "{user_id}_{product_id}"
+def parse_invoice_payload(payload: str) -> Optional[Tuple[int, int]]:
+    parts = payload.split("_")
+    if len(parts) < 2 or not parts[0].isdigit() or not parts[1].isdigit():
+        return None
+    return int(parts[0]), int(parts[1])
+
+
+# Проверка перед оплатой: Telegram ждёт ответ не больше 10 секунд, поэтому только данные из памяти
 @dp.pre_checkout_query()
 async def process_pre_checkout_query(pre_checkout_query: types.PreCheckoutQuery):
+    parsed = parse_invoice_payload(pre_checkout_query.invoice_payload)
+    product = await catalog.get_by_id(parsed[1]) if parsed else None
+
+    error = None
+    if not product or parsed[0] != pre_checkout_query.from_user.id:
+        error = "Товар не найден. Пожалуйста, оформите заказ заново."
+    elif pre_checkout_query.currency != "RUB" or pre_checkout_query.total_amount != product[3] * 100:
+        error = "Цена товара изменилась. Пожалуйста, оформите заказ заново."
+    elif inventory.stock(product[0]) <= 0:
+        error = "К сожалению, этот товар закончился."
+
+    if error:
+        metrics.inc('pre_checkout_rejected_total')
+        await bot.answer_pre_checkout_query(pre_checkout_query.id, ok=False, error_message=error)
+        return
     await bot.answer_pre_checkout_query(pre_checkout_query.id, ok=True)
 
 
-# Обработка успешной оплаты
+# Обработка успешной оплаты. Заказ восстанавливается из payload счёта,
+# поэтому перезапуск бота между счётом и оплатой ничего не ломает
 @dp.message(F.successful_payment)
 async def process_successful_payment(message: Message, state: FSMContext):
     user_id = message.from_user.id
-    order_info = pending_orders.get(user_id)
-
-    if not order_info:
-        await message.answer("Произошла ошибка. Информация о заказе не найдена.")
+    payment = message.successful_payment
+    parsed = parse_invoice_payload(payment.invoice_payload)
+    if not parsed:
+        logger.error(f"Платёж {payment.telegram_payment_charge_id} с неизвестным payload: {payment.invoice_payload}")
+        await message.answer("Произошла ошибка. Информация о заказе не найдена. Пожалуйста, свяжитесь с поддержкой.")
         await state.clear()
         return
 
+    charge_id = payment.telegram_payment_charge_id
     try:
-        conn = sqlite3.connect('database.db')
-        cursor = conn.cursor()
-
-        cursor.execute(
-            "SELECT code FROM products_code WHERE id_product = ? LIMIT 1",
-            (order_info['product_id'],)
+        registered = await payments.register(charge_id, user_id, parsed[1], payment.total_amount)
+        recorded = None if registered else await db.get_payment_order(charge_id)
+    except sqlite3.Error as e:
+        logger.error(f"Не удалось записать платёж {charge_id}: {e}")
+        await message.answer(
+            f"Оплата получена, но при выдаче товара произошла ошибка. "
+            f"Пожалуйста, свяжитесь с поддержкой и сообщите номер платежа: {charge_id}"
         )
-        code_data = cursor.fetchone()
-        code = code_data[0] if code_data else "Код не найден. Пожалуйста, свяжитесь с поддержкой."
+        return
 
-    except sqlite3.Error as e:
-        logger.error(f"Ошибка при работе с БД: {e}")
-        code = "Ошибка получения кода. Пожалуйста, свяжитесь с поддержкой."
-    finally:
-        conn.close()
+    # Повторный апдейт о том же платеже не должен выдать второй код.
+    # Если заказ уже записан - повторяем код, если процесс упал до записи заказа - завершаем заказ
+    if not registered:
+        if recorded and recorded[1] is not None:
+            logger.warning(f"Повторное уведомление о платеже {charge_id}: код отправлен повторно")
+            code = recorded[2] or "Код не найден. Пожалуйста, свяжитесь с поддержкой."
+            await message.answer(
+                f"✅ Оплата уже получена.\n\n"
+                f"🔑 Ваш код: <code>{code}</code>\n\n"
+                f"Сохраните его в надежном месте!",
+                reply_markup=get_main_menu(),
+                parse_mode=ParseMode.HTML
+            )
+            return
+        if not recorded or time.time() - recorded[0] < PAYMENT_RECOVERY_DELAY:
+            logger.warning(f"Повторное уведомление о платеже {charge_id} пропущено: платёж ещё обрабатывается")
+            return
+        # Восстанавливает заказ только один из одновременных повторов
+        try:
+            recovering = await db.start_payment_recovery(charge_id)
+        except sqlite3.Error as e:
+            logger.error(f"Не удалось начать восстановление заказа по платежу {charge_id}: {e}")
+            recovering = False
+        if not recovering:
+            logger.warning(f"Повторное уведомление о платеже {charge_id} пропущено: заказ уже восстанавливается")
+            return
+        logger.warning(f"Платёж {charge_id} записан, но заказ по нему не оформлен: завершаем заказ")
+
+    product = await catalog.get_by_id(parsed[1])
+    order_info = {
+        'order_id': charge_id,
+        'user_id': user_id,
+        'product_id': parsed[1],
+        'product_name': product[1] if product else f"Товар #{parsed[1]}",
+        'price': payment.total_amount // 100,
+    }
+
+    code = await complete_order(order_info, 'paid', 'online')
 
     # Уведомление администраторам
     admin_message = (
@@ -336,15 +703,11 @@ async def process_successful_payment(message: Message, state: FSMContext):
         f"🔑 Выданный код: {code}"
     )
 
-    for admin_id in ADMINS:
-        try:
-            await bot.send_message(
-                chat_id=admin_id,
-                text=admin_message,
-                parse_mode=ParseMode.HTML
-            )
-        except Exception as e:
-            logger.error(f"Не удалось отправить уведомление администратору {admin_id}: {e}")
+    notifier.notify_admins(ADMINS, lambda admin_id: SendMessage(
+        chat_id=admin_id,
+        text=admin_message,
+        parse_mode=ParseMode.HTML
+    ))
 
     # Отправка купленного товара пользователю
     await message.answer(
@@ -355,8 +718,10 @@ async def process_successful_payment(message: Message, state: FSMContext):
         parse_mode=ParseMode.HTML
     )
 
-    if user_id in pending_orders:
-        del pending_orders[user_id]
+    # Черновик заказа больше не нужен (в старых счетах его id шёл третьим полем payload)
+    draft_ids = {(await state.get_data()).get('order_id'), *payment.invoice_payload.split("_")[2:3]}
+    for order_id in filter(None, draft_ids):
+        await orders.delete(order_id)
     await state.clear()
 
 
@@ -375,7 +740,7 @@ async def handle_payment_confirmation(callback: types.CallbackQuery, state: FSMC
 @dp.message(PaymentStates.WAITING_PAYMENT_PROOF, F.photo)
 async def handle_payment_proof(message: Message, state: FSMContext):
     user_id = message.from_user.id
-    order_info = pending_orders.get(user_id)
+    order_info = await get_current_order(state)
 
     if not order_info:
         await message.answer("Произошла ошибка. Пожалуйста, попробуйте оформить заказ снова.")
@@ -394,23 +759,19 @@ async def handle_payment_proof(message: Message, state: FSMContext):
 
     admin_keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
         [
-            types.InlineKeyboardButton(text="✅ Подтвердить", callback_data=f"admin_confirm_{user_id}"),
-            types.InlineKeyboardButton(text="❌ Отклонить", callback_data=f"admin_reject_{user_id}")
+            types.InlineKeyboardButton(text="✅ Подтвердить", callback_data=f"admin_confirm_{order_info['order_id']}"),
+            types.InlineKeyboardButton(text="❌ Отклонить", callback_data=f"admin_reject_{order_info['order_id']}")
         ]
     ])
 
     # Отправляем фото и информацию администраторам
-    for admin_id in ADMINS:
-        try:
-            await bot.send_photo(
-                chat_id=admin_id,
-                photo=message.photo[-1].file_id,
-                caption=admin_message,
-                reply_markup=admin_keyboard,
-                parse_mode=ParseMode.HTML
-            )
-        except Exception as e:
-            logger.error(f"Не удалось отправить уведомление администратору {admin_id}: {e}")
+    notifier.notify_admins(ADMINS, lambda admin_id: SendPhoto(
+        chat_id=admin_id,
+        photo=message.photo[-1].file_id,
+        caption=admin_message,
+        reply_markup=admin_keyboard,
+        parse_mode=ParseMode.HTML
+    ))
 
     await message.answer(
         "Спасибо! Ваш платеж отправлен на проверку администратору. "
@@ -421,33 +782,20 @@ async def handle_payment_proof(message: Message, state: FSMContext):
 
 
 # Подтверждение администратором оплаты товара
-@dp.callback_query(F.data.startswith("admin_confirm_"))
+@dp.callback_query(F.data.startswith("admin_confirm_") | F.data.startswith("admin_reject_"))
 async def handle_admin_decision(callback: CallbackQuery):
-    action, user_id = callback.data.split("_")[1], int(callback.data.split("_")[2])
-    order_info = pending_orders.get(user_id)
+    action, order_id = callback.data.split("_")[1], callback.data.split("_")[2]
+    # Заказ забирается из хранилища сразу: повторное нажатие кнопки его уже не найдёт
+    order_info = await orders.take(order_id)
 
     if not order_info:
         await callback.answer("Заказ не найден!")
         return
-
-    try:
-        conn = sqlite3.connect('database.db')
-        cursor = conn.cursor()
-
-        cursor.execute(
-            "SELECT code FROM products_code WHERE id_product = ? LIMIT 1",
-            (order_info['product_id'],)
-        )
-        code_data = cursor.fetchone()
-        code = code_data[0] if code_data else "Код не найден. Пожалуйста, свяжитесь с поддержкой."
-
-    except sqlite3.Error as e:
-        logger.error(f"Ошибка при работе с БД: {e}")
-        code = "Ошибка получения кода. Пожалуйста, свяжитесь с поддержкой."
-    finally:
-        conn.close()
+    user_id = order_info['user_id']
 
     if action == "confirm":
+        code = await complete_order(order_info, 'confirmed', 'admin')
+
         try:
             await bot.send_message(
                 chat_id=user_id,
@@ -468,6 +816,11 @@ async def handle_admin_decision(callback: CallbackQuery):
             reply_markup=None
         )
     else:
+        try:
+            await db.add_order(user_id, order_info['product_id'], order_id, 'rejected', order_info['price'], None, 'admin')
+        except sqlite3.Error as e:
+            logger.error(f"Не удалось записать заказ {order_id} в историю: {e}")
+
         try:
             await bot.send_message(
                 chat_id=user_id,
@@ -485,8 +838,157 @@ async def handle_admin_decision(callback: CallbackQuery):
             reply_markup=None
         )
 
-    if user_id in pending_orders:
-        del pending_orders[user_id]
+
+# Рассылка всем пользователям
+@dp.message(Command("broadcast"))
+async def cmd_broadcast(message: Message, command: CommandObject):
+    if not await is_admin(message.from_user.id):
+        return
+    if not command.args:
+        await message.answer("Использование: /broadcast текст сообщения")
+        return
+
+    await message.answer("📣 Рассылка запущена")
+
+    async def run_broadcast():
+        try:
+            await users.flush()
+            stats = await notifier.broadcast(command.args)
+        except Exception as e:
+            logger.error(f"Ошибка рассылки: {e}")
+            await message.answer(f"❌ Рассылка прервана: {e}")
+            return
+        await message.answer(
+            f"📣 Рассылка завершена\n"
+            f"✅ Доставлено: {stats.sent}\n"
+            f"❌ Ошибок: {stats.failed}"
+        )
+
+    spawn(run_broadcast(), name="broadcast")
+
+
+# Поток байтов документа с серверов Telegram, файл целиком не скачивается
+def stream_document(file_path: str):
+    url = bot.session.api.file_url(bot.token, file_path)
+    return bot.session.stream_content(url=url, timeout=600)
+
+
+def format_import_stats(stats: ImportStats) -> str:
+    return (
+        f"Строк: {stats.rows}\n"
+        f"✅ Добавлено: {stats.inserted}\n"
+        f"♻️ Дубликатов: {stats.duplicates}\n"
+        f"🚫 Отклонено: {stats.rejected}"
+    )
+
+
+# Загрузка кодов или товаров из CSV/TXT-файла, отправленного с подписью /import.
+# Облачный Bot API отдаёт боту файлы не больше 20 МБ (примерно 500 тысяч коротких кодов),
+# файлы крупнее - частями или через локальный сервер Bot API
+@dp.message(Command("import"))
+async def cmd_import(message: Message, command: CommandObject):
+    if not await is_admin(message.from_user.id):
+        return
+    args = (command.args or '').strip()
+    if not message.document or not (args in ('', 'products') or args.isdigit()):
+        await message.answer(
+            "Пришлите файл CSV/TXT с подписью:\n"
+            "/import <id товара> — коды по одному в строке\n"
+            "/import — строки вида «id_товара,код»\n"
+            "/import products — товары с заголовком name,description,price,photo\n\n"
+            "Файл — не больше 20 МБ (ограничение Telegram для ботов). "
+            "Большие списки разбейте на несколько файлов."
+        )
+        return
+
+    status = await message.answer("📥 Импорт начат…")
+
+    async def on_progress(stats: ImportStats):
+        try:
+            await status.edit_text(f"📥 Импорт идёт…\n{format_import_stats(stats)}")
+        except TelegramBadRequest:
+            pass
+
+    async def run_import():
+        try:
+            file = await bot.get_file(message.document.file_id)
+            if args == 'products':
+                stats = await import_products(stream_document(file.file_path), on_progress=on_progress)
+                catalog.invalidate()
+                await prepare_photos()
+            else:
+                stats = await import_codes(stream_document(file.file_path), int(args) if args else None,
+                                           on_progress=on_progress)
+                await inventory.refresh_stock()
+        except Exception as e:
+            logger.error(f"Ошибка импорта из файла {message.document.file_name}: {e}")
+            await message.answer(f"❌ Импорт прерван: {e}")
+            return
+        await message.answer(f"📥 Импорт завершён\n{format_import_stats(stats)}")
+
+    spawn(run_import(), name="import")
+
+
+# Строка отчёта: продажи, выручка и конверсия просмотров в покупки
+def format_sales(views: int, checkouts: int, units: int, revenue: int) -> str:
+    conversion = f"{units / views * 100:.1f}%" if views else "—"
+    return f"{units} шт., {revenue} руб., просмотров {views}, начато покупок {checkouts}, конверсия {conversion}"
+
+
+# Отчёт о продажах: /report [число дней] | /report week | /report csv
+@dp.message(Command("report"))
+async def cmd_report(message: Message, command: CommandObject):
+    if not await is_admin(message.from_user.id):
+        return
+    args = (command.args or '').strip().lower()
+    await sales.flush()
+
+    if args == 'csv':
+        await message.answer_document(SalesCsvFile(f"sales_{format_day(today())}.csv"),
+                                      caption="📊 Продажи по дням и товарам (UTC)")
+        return
+
+    if args == 'week':
+        period_days, periods, title = 7, 8, "8 недель"
+    elif args.isdigit() and 0 < int(args) <= 366:
+        period_days, periods, title = 1, int(args), f"{args} дн."
+    else:
+        period_days, periods, title = 1, 7, "7 дней"
+    if period_days == 7:
+        # Целые недели с понедельника (день 0 - четверг 01.01.1970)
+        since = ((today() + 3) // 7 - periods + 1) * 7 - 3
+    else:
+        since = today() - periods + 1
+
+    lines = [f"📊 <b>Продажи за {title}</b> (UTC)\n"]
+    totals = [0, 0, 0, 0]
+    for period, *values in await db.get_sales_by_period(since, period_days):
+        start_day = period * 7 - 3 if period_days == 7 else period
+        label = f"с {format_day(start_day)}" if period_days == 7 else format_day(start_day)
+        lines.append(f"📅 {label}: {format_sales(*values)}")
+        totals = [total + value for total, value in zip(totals, values)]
+    if len(lines) == 1:
+        await message.answer("За этот период продаж и просмотров не было")
+        return
+    lines.append(f"\n<b>Итого:</b> {format_sales(*totals)}\n\n<b>По товарам:</b>")
+    for product_id, name, *values in await db.get_sales_by_product(since, 20):
+        lines.append(f"📦 {html.quote(name or f'Товар #{product_id}')}: {format_sales(*values)}")
+    await message.answer("\n".join(lines), parse_mode=ParseMode.HTML)
+
+
+# Статистика производительности для администраторов
+@dp.message(Command("stats"))
+async def cmd_stats(message: Message):
+    if not await is_admin(message.from_user.id):
+        return
+    cache = catalog.stats()
+    await message.answer(
+        f"{summary()}\n\n"
+        f"📦 Кэш каталога: {cache['hits']} попаданий, {cache['misses']} промахов\n"
+        f"🖼 Кэш фото: {media.hits} попаданий, {media.misses} промахов\n"
+        f"📨 Уведомлений отправлено: {notifier.sent}, не доставлено: {notifier.dead}\n"
+        f"🚧 Ограничено частых апдейтов: {throttling.dropped} отброшено, {throttling.coalesced} склеено"
+    )
 
 
 # Служило для отладки клавиатуры
@@ -501,13 +1003,43 @@ async def cmd_menu(message: Message):
     await message.answer("Главное меню:", reply_markup=get_main_menu())
 
 
+# Подготовка при запуске (общая для polling и вебхука)
+@dp.startup()
+async def on_startup():
+    await db.init()
+    await prepare_photos()
+    await media.load()
+    await inventory.start()
+    await payments.load()
+    await notifier.start()
+    await users.start()
+    await sales.start()
+    if isinstance(dp.storage, SQLiteStorage):
+        await dp.storage.start()
+
+
+@dp.shutdown()
+async def on_shutdown():
+    await users.stop()
+    await sales.stop()
+    await dp.storage.close()
+    await notifier.stop()
+    await inventory.stop()
+    await orders.close()
+    await db.close()
+
+
 # Запуск бота
 async def main():
     logger.info("Start")
-    await dp.start_polling(bot)
+    if config['METRICS_PORT']:
+        await start_metrics_server(config['METRICS_HOST'], int(config['METRICS_PORT']))
+    if config['MODE'] == 'webhook':
+        from webhook import run_webhook
+        await run_webhook(dp, bot, config)
+    else:
+        await dp.start_polling(bot)
 
 
 if __name__ == "__main__":
-    import asyncio
-
     asyncio.run(main())
@@ -0,0 +1,59 @@
+import logging
+import os
+from typing import Dict, Optional, Tuple
+
+import db
+
+logger = logging.getLogger(__name__)
+
+# Ошибки Telegram, после которых сохранённый file_id нужно забыть и загрузить файл заново
+FILE_ERRORS = (
+    'wrong file identifier', 'wrong remote file identifier', 'wrong padding', 'file_reference',
+    'failed to get http url content', 'wrong type of the web page content', 'photo_invalid', 'image_process_failed',
+)
+
+
+def is_file_error(error: Exception) -> bool:
+    message = str(error).lower()
+    return any(text in message for text in FILE_ERRORS)
+
+
+# Кэш file_id загруженных в Telegram фотографий.
+# Ключ - путь к файлу, запись действительна пока не изменились mtime и размер файла.
+class MediaCache:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._file_ids: Dict[str, Tuple[int, int, str]] = {}
+
+    async def load(self):
+        for path, mtime_ns, size, file_id in await db.get_media_cache():
+            self._file_ids[path] = (mtime_ns, size, file_id)
+        logger.info(f"Загружено file_id фотографий: {len(self._file_ids)}")
+
+    @staticmethod
+    def _signature(path: str) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def get(self, path: str) -> Optional[str]:
+        cached = self._file_ids.get(path)
+        if cached and self._signature(path) == cached[:2]:
+            self.hits += 1
+            return cached[2]
+        self.misses += 1
+        return None
+
+    async def remember(self, path: str, file_id: str):
+        signature = self._signature(path)
+        if signature is None:
+            return
+        self._file_ids[path] = (*signature, file_id)
+        await db.put_media_cache(path, *signature, file_id)
+
+    async def forget(self, path: str):
+        self._file_ids.pop(path, None)
+        await db.delete_media_cache(path)
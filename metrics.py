@@ -0,0 +1,213 @@
+import bisect
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import TelegramObject
+
+# Границы корзин гистограмм задержек, в секундах
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    # Оценка квантиля по корзинам (верхняя граница корзины)
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return BUCKETS[index] if index < len(BUCKETS) else float('inf')
+        return float('inf')
+
+
+# Метрики процесса в памяти с выводом в текстовом формате Prometheus
+class Metrics:
+    def __init__(self):
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.gauges: Dict[str, Dict[Labels, float]] = {}
+        # Функции, обновляющие показатели перед выводом (размеры кэшей и т.п.)
+        self.collectors: List[Callable[[], None]] = []
+
+    @staticmethod
+    def _labels(labels: Dict[str, Any]) -> Labels:
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def observe(self, name: str, value: float, **labels):
+        series = self.histograms.setdefault(name, {})
+        key = self._labels(labels)
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram()
+        histogram.observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        series = self.counters.setdefault(name, {})
+        key = self._labels(labels)
+        series[key] = series.get(key, 0) + value
+
+    def gauge(self, name: str, value: float, **labels):
+        self.gauges.setdefault(name, {})[self._labels(labels)] = value
+
+    def gauge_add(self, name: str, value: float, **labels):
+        series = self.gauges.setdefault(name, {})
+        key = self._labels(labels)
+        series[key] = series.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @staticmethod
+    def _format_labels(labels: Labels, extra: str = '') -> str:
+        parts = [f'{key}="{value}"' for key, value in labels]
+        if extra:
+            parts.append(extra)
+        return '{' + ','.join(parts) + '}' if parts else ''
+
+    def render(self) -> str:
+        for collect in self.collectors:
+            collect()
+        lines: List[str] = []
+        for name, series in self.counters.items():
+            lines.append(f"# TYPE {name} counter")
+            for labels, value in series.items():
+                lines.append(f"{name}{self._format_labels(labels)} {value}")
+        for name, series in self.gauges.items():
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in series.items():
+                lines.append(f"{name}{self._format_labels(labels)} {value}")
+        for name, series in self.histograms.items():
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in series.items():
+                cumulative = 0
+                for bound, count in zip(BUCKETS + (float('inf'),), histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    bucket_labels = self._format_labels(labels, 'le="' + le + '"')
+                    lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+                lines.append(f"{name}_sum{self._format_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{self._format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+# Внешний middleware на апдейты: общее время обработки и число апдейтов в работе
+class UpdateMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        event_type = getattr(event, 'event_type', 'unknown')
+        metrics.gauge_add('bot_updates_in_flight', 1)
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.inc('bot_update_errors_total', event_type=event_type)
+            raise
+        finally:
+            metrics.observe('bot_update_seconds', time.perf_counter() - start, event_type=event_type)
+            metrics.gauge_add('bot_updates_in_flight', -1)
+
+
+# Middleware на обработчики: задержка каждого хендлера по имени
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        handler_object = data.get('handler')
+        name = getattr(getattr(handler_object, 'callback', None), '__name__', 'unknown')
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            metrics.observe('bot_handler_seconds', time.perf_counter() - start, handler=name)
+
+
+# Сессия бота, замеряющая каждый вызов Bot API
+class InstrumentedSession(AiohttpSession):
+    async def make_request(self, bot, method, timeout=None):
+        name = type(method).__name__
+        start = time.perf_counter()
+        try:
+            return await super().make_request(bot, method, timeout=timeout)
+        except TelegramRetryAfter:
+            metrics.inc('bot_api_retry_after_total', method=name)
+            raise
+        except Exception:
+            metrics.inc('bot_api_errors_total', method=name)
+            raise
+        finally:
+            metrics.observe('bot_api_seconds', time.perf_counter() - start, method=name)
+
+
+def observe_query(name: str, seconds: float):
+    metrics.observe('db_query_seconds', seconds, query=name)
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(body=metrics.render().encode(),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+# Отдельный HTTP-сервер с /metrics на METRICS_HOST:METRICS_PORT (в обоих режимах)
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+# Короткая сводка для команды /stats
+def summary(top: int = 10) -> str:
+    lines = []
+    for collect in metrics.collectors:
+        collect()
+    in_flight = metrics.gauges.get('bot_updates_in_flight', {}).get((), 0)
+    lines.append(f"⏳ Апдейтов в обработке: {in_flight:.0f}")
+    for title, name, label in (
+        ("🧩 Хендлеры", 'bot_handler_seconds', 'handler'),
+        ("📡 Bot API", 'bot_api_seconds', 'method'),
+        ("🗄 SQL", 'db_query_seconds', 'query'),
+    ):
+        series = metrics.histograms.get(name, {})
+        if not series:
+            continue
+        lines.append(f"\n{title} (вызовов, p50, p99):")
+        ranked = sorted(series.items(), key=lambda item: item[1].sum, reverse=True)[:top]
+        for labels, histogram in ranked:
+            label_value = dict(labels).get(label, '?')
+            lines.append(
+                f"{label_value}: {histogram.count}, "
+                f"{histogram.quantile(0.5) * 1000:.1f} мс, {histogram.quantile(0.99) * 1000:.1f} мс"
+            )
+    retries = sum(metrics.counters.get('bot_api_retry_after_total', {}).values())
+    lines.append(f"\n🚦 RetryAfter от Telegram: {retries:.0f}")
+    return "\n".join(lines)
@@ -0,0 +1,203 @@
+import asyncio
+import itertools
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest, TelegramRetryAfter
+from aiogram.methods import SendMessage, TelegramMethod
+
+import db
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_HIGH = 0
+PRIORITY_BROADCAST = 1
+
+
+# Ведро токенов: не больше rate запросов в секунду с запасом capacity
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _fill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self):
+        while True:
+            self._fill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    # Забрать токен без ожидания; False, если ведро пустое
+    def try_acquire(self) -> bool:
+        self._fill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def is_full(self) -> bool:
+        self._fill()
+        return self.tokens >= self.capacity
+
+
+# Счётчики одной рассылки
+@dataclass
+class BroadcastStats:
+    total: int = 0
+    sent: int = 0
+    failed: int = 0
+    queued_all: bool = False
+    finished: asyncio.Event = field(default_factory=asyncio.Event)
+
+    def mark(self, ok: bool):
+        if ok:
+            self.sent += 1
+        else:
+            self.failed += 1
+        if self.queued_all and self.sent + self.failed >= self.total:
+            self.finished.set()
+
+
+@dataclass(order=True)
+class Job:
+    priority: int
+    seq: int
+    method: TelegramMethod = field(compare=False)
+    attempt: int = field(default=0, compare=False)
+    stats: Optional[BroadcastStats] = field(default=None, compare=False)
+
+
+# Фоновая отправка сообщений с учётом лимитов Telegram:
+# ~30 сообщений в секунду на бота и 1 сообщение в секунду в один чат
+class Notifier:
+    def __init__(self, bot: Bot, workers: int = 8, global_rate: float = 30, chat_rate: float = 1,
+                 max_retries: int = 5, max_queue: int = 1000):
+        self.bot = bot
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.max_retries = max_retries
+        self.max_queue = max_queue
+        self.sent = 0
+        self.dead = 0
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: Dict[int, TokenBucket] = {}
+        self._queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        self._seq = itertools.count()
+        self._tasks: List[asyncio.Task] = []
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10.0):
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Не отправлено при остановке: {self._queue.qsize()} сообщений")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def send(self, method: TelegramMethod, priority: int = PRIORITY_HIGH, stats: BroadcastStats = None):
+        self._queue.put_nowait(Job(priority, next(self._seq), method, stats=stats))
+
+    # Уведомление всем администраторам
+    def notify_admins(self, admins: List[int], make_method):
+        for admin_id in admins:
+            self.send(make_method(admin_id))
+
+    # Рассылка по всем пользователям из таблицы users
+    async def broadcast(self, text: str, batch_size: int = 500) -> BroadcastStats:
+        stats = BroadcastStats()
+        last_id = 0
+        while True:
+            rows = await db.get_users_page(last_id, batch_size)
+            if not rows:
+                break
+            for _, tg_id in rows:
+                # не даём рассылке занять всю очередь и память
+                while self._queue.qsize() >= self.max_queue:
+                    await asyncio.sleep(0.1)
+                stats.total += 1
+                self.send(SendMessage(chat_id=tg_id, text=text), PRIORITY_BROADCAST, stats)
+            last_id = rows[-1][0]
+        stats.queued_all = True
+        if stats.sent + stats.failed >= stats.total:
+            stats.finished.set()
+        await stats.finished.wait()
+        return stats
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                self._chats = {key: value for key, value in self._chats.items() if not value.is_full()}
+            rate = self.chat_rate if chat_id > 0 else 20 / 60
+            bucket = self._chats[chat_id] = TokenBucket(rate, 1)
+        return bucket
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._deliver(job)
+            except Exception as e:
+                logger.exception(f"Ошибка в очереди уведомлений: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, job: Job):
+        chat_id = getattr(job.method, 'chat_id', 0)
+        await self._chat_bucket(chat_id).acquire()
+        await self._global.acquire()
+        try:
+            await self.bot(job.method)
+        except TelegramRetryAfter as e:
+            logger.warning(f"Флуд-лимит для {chat_id}, повтор через {e.retry_after} с")
+            await asyncio.sleep(e.retry_after)
+            await self._retry(job, e)
+            return
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            await self._dead_letter(job, e)
+            return
+        except Exception as e:
+            await asyncio.sleep(min(2 ** job.attempt, 60))
+            await self._retry(job, e)
+            return
+        self.sent += 1
+        if job.stats:
+            job.stats.mark(True)
+
+    async def _retry(self, job: Job, error: Exception):
+        if job.attempt + 1 >= self.max_retries:
+            await self._dead_letter(job, error)
+            return
+        job.attempt += 1
+        job.seq = next(self._seq)
+        self._queue.put_nowait(job)
+
+    async def _dead_letter(self, job: Job, error: Exception):
+        self.dead += 1
+        chat_id = getattr(job.method, 'chat_id', 0)
+        logger.error(f"Не удалось отправить {type(job.method).__name__} в чат {chat_id}: {error}")
+        if job.stats:
+            job.stats.mark(False)
+        try:
+            payload = job.method.model_dump_json(exclude_none=True)
+        except Exception:
+            payload = repr(job.method)
+        try:
+            await db.add_dead_letter(chat_id, type(job.method).__name__, payload, str(error))
+        except Exception as e:
+            logger.error(f"Не удалось записать в журнал недоставленных: {e}")
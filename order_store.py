@@ -0,0 +1,177 @@
+import json
+import logging
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import db
+
+logger = logging.getLogger(__name__)
+
+
+def new_order_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+# Хранилище незавершённых заказов: ключ - id заказа, записи живут ttl секунд,
+# при переполнении вытесняются давно не использованные
+class OrderStore(ABC):
+    def __init__(self, ttl: float = 86400, max_size: int = 10000):
+        self.ttl = ttl
+        self.max_size = max_size
+
+    async def create(self, user_id: int, data: Dict) -> str:
+        order_id = new_order_id()
+        await self.put(order_id, {**data, 'order_id': order_id, 'user_id': user_id})
+        return order_id
+
+    @abstractmethod
+    async def put(self, order_id: str, data: Dict):
+        ...
+
+    @abstractmethod
+    async def get(self, order_id: str) -> Optional[Dict]:
+        ...
+
+    @abstractmethod
+    async def delete(self, order_id: str):
+        ...
+
+    # Достаёт заказ и сразу удаляет его. При одновременных вызовах заказ получит только один
+    @abstractmethod
+    async def take(self, order_id: str) -> Optional[Dict]:
+        ...
+
+    async def close(self):
+        pass
+
+
+class MemoryOrderStore(OrderStore):
+    def __init__(self, ttl: float = 86400, max_size: int = 10000):
+        super().__init__(ttl, max_size)
+        self._orders: "OrderedDict[str, Tuple[float, Dict]]" = OrderedDict()
+
+    def _purge(self, now: float):
+        while self._orders:
+            order_id, (expires_at, _) = next(iter(self._orders.items()))
+            if expires_at > now and len(self._orders) <= self.max_size:
+                break
+            del self._orders[order_id]
+
+    async def put(self, order_id: str, data: Dict):
+        now = time.time()
+        self._orders[order_id] = (now + self.ttl, data)
+        self._orders.move_to_end(order_id)
+        self._purge(now)
+
+    async def get(self, order_id: str) -> Optional[Dict]:
+        item = self._orders.get(order_id)
+        if item is None:
+            return None
+        expires_at, data = item
+        if expires_at <= time.time():
+            del self._orders[order_id]
+            return None
+        self._orders[order_id] = (time.time() + self.ttl, data)
+        self._orders.move_to_end(order_id)
+        return data
+
+    async def delete(self, order_id: str):
+        self._orders.pop(order_id, None)
+
+    async def take(self, order_id: str) -> Optional[Dict]:
+        item = self._orders.pop(order_id, None)
+        if item is None or item[0] <= time.time():
+            return None
+        return item[1]
+
+    def __len__(self):
+        return len(self._orders)
+
+
+class SQLiteOrderStore(OrderStore):
+    # Раз в столько вставок удаляются просроченные и лишние заказы
+    PURGE_EVERY = 100
+
+    def __init__(self, ttl: float = 86400, max_size: int = 10000):
+        super().__init__(ttl, max_size)
+        self._writes = 0
+
+    async def put(self, order_id: str, data: Dict):
+        now = time.time()
+        await db.put_pending_order(order_id, data['user_id'], json.dumps(data, ensure_ascii=False), now + self.ttl)
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            removed = await db.purge_pending_orders(now, self.max_size)
+            if removed:
+                logger.info(f"Удалено устаревших заказов: {removed}")
+
+    async def get(self, order_id: str) -> Optional[Dict]:
+        data = await db.touch_pending_order(order_id, time.time(), self.ttl)
+        return json.loads(data) if data else None
+
+    async def delete(self, order_id: str):
+        await db.delete_pending_order(order_id)
+
+    async def take(self, order_id: str) -> Optional[Dict]:
+        data = await db.take_pending_order(order_id, time.time())
+        return json.loads(data) if data else None
+
+
+# Redis-бэкенд для нескольких процессов бота (нужен пакет redis)
+class RedisOrderStore(OrderStore):
+    PREFIX = "shop_bot:order:"
+    LRU_KEY = "shop_bot:orders_lru"
+
+    def __init__(self, url: str, ttl: float = 86400, max_size: int = 10000, client=None):
+        super().__init__(ttl, max_size)
+        if client is None:
+            from redis.asyncio import Redis
+            client = Redis.from_url(url, decode_responses=True)
+        self.redis = client
+
+    async def put(self, order_id: str, data: Dict):
+        now = time.time()
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.set(self.PREFIX + order_id, json.dumps(data, ensure_ascii=False), ex=int(self.ttl))
+            pipe.zadd(self.LRU_KEY, {order_id: now})
+            pipe.zremrangebyscore(self.LRU_KEY, 0, now - self.ttl)
+            pipe.zcard(self.LRU_KEY)
+            size = (await pipe.execute())[-1]
+        if size > self.max_size:
+            evicted = await self.redis.zpopmin(self.LRU_KEY, size - self.max_size)
+            if evicted:
+                await self.redis.delete(*(self.PREFIX + order_id for order_id, _ in evicted))
+
+    async def get(self, order_id: str) -> Optional[Dict]:
+        data = await self.redis.getex(self.PREFIX + order_id, ex=int(self.ttl))
+        if data is None:
+            return None
+        await self.redis.zadd(self.LRU_KEY, {order_id: time.time()})
+        return json.loads(data)
+
+    async def delete(self, order_id: str):
+        await self.redis.delete(self.PREFIX + order_id)
+        await self.redis.zrem(self.LRU_KEY, order_id)
+
+    async def take(self, order_id: str) -> Optional[Dict]:
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.getdel(self.PREFIX + order_id)
+            pipe.zrem(self.LRU_KEY, order_id)
+            data = (await pipe.execute())[0]
+        return json.loads(data) if data else None
+
+    async def close(self):
+        await self.redis.aclose()
+
+
+def create_order_store(backend: str, ttl: float, max_size: int, redis_url: str = '') -> OrderStore:
+    if backend == 'memory':
+        return MemoryOrderStore(ttl, max_size)
+    if backend == 'sqlite':
+        return SQLiteOrderStore(ttl, max_size)
+    if backend == 'redis':
+        return RedisOrderStore(redis_url, ttl, max_size)
+    raise ValueError(f"Неизвестное хранилище заказов: {backend}")
@@ -0,0 +1,44 @@
+import logging
+from collections import deque
+from typing import Deque, Set
+
+import db
+
+logger = logging.getLogger(__name__)
+
+
+# Защита от повторной выдачи товара за один платёж.
+# Последние charge_id держим в памяти, окончательное решение - по первичному ключу в таблице payments.
+class PaymentRegistry:
+    def __init__(self, hot_size: int = 10000):
+        self.hot_size = hot_size
+        self.duplicates = 0
+        self._seen: Set[str] = set()
+        self._order: Deque[str] = deque()
+
+    async def load(self):
+        for charge_id in reversed(await db.get_recent_payments(self.hot_size)):
+            self._remember(charge_id)
+
+    def _remember(self, charge_id: str):
+        self._seen.add(charge_id)
+        self._order.append(charge_id)
+        if len(self._order) > self.hot_size:
+            self._seen.discard(self._order.popleft())
+
+    # True, если платёж пришёл впервые и по нему нужно выдать товар
+    async def register(self, charge_id: str, tg_id: int, product_id: int, amount: int) -> bool:
+        # Проверка и отметка без await: повторный апдейт в этом же процессе не проскочит
+        if charge_id in self._seen:
+            self.duplicates += 1
+            return False
+        self._remember(charge_id)
+        try:
+            added = await db.add_payment(charge_id, tg_id, product_id, amount)
+        except Exception:
+            self._seen.discard(charge_id)
+            raise
+        if not added:
+            self.duplicates += 1
+            return False
+        return True
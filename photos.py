@@ -0,0 +1,117 @@
+import asyncio
+import hashlib
+import io
+import logging
+import os
+from typing import Optional, Tuple
+
+import aiofiles
+
+import db
+
+logger = logging.getLogger(__name__)
+
+MEDIA_DIR = 'media'
+# Telegram всё равно ужимает фото до 1280 px по большей стороне
+PHOTO_SIDE = 1280
+PHOTO_MAX_BYTES = 200 * 1024
+THUMB_SIDE = 320
+
+
+async def read_file(path: str) -> bytes:
+    async with aiofiles.open(path, 'rb') as file:
+        return await file.read()
+
+
+def _encode(image, max_bytes: Optional[int], quality: int = 85) -> bytes:
+    while True:
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=quality, optimize=True, progressive=True)
+        data = buffer.getvalue()
+        if max_bytes is None or len(data) <= max_bytes or quality <= 50:
+            return data
+        quality -= 10
+
+
+def _write(path: str, data: bytes):
+    if os.path.exists(path):
+        return
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as file:
+        file.write(data)
+    os.replace(temp_path, path)
+
+
+# Прогрессивный JPEG не больше PHOTO_MAX_BYTES и миниатюра.
+# Имена файлов - хэш исходника, поэтому повторная обработка того же фото ничего не делает.
+def render_photo(source: str, media_dir: str = MEDIA_DIR) -> Tuple[str, str]:
+    from PIL import Image, ImageOps
+
+    with open(source, 'rb') as file:
+        data = file.read()
+    digest = hashlib.sha256(data).hexdigest()[:32]
+    photo_path = os.path.join(media_dir, f"{digest}.jpg")
+    thumb_path = os.path.join(media_dir, f"{digest}_thumb.jpg")
+    if os.path.exists(photo_path) and os.path.exists(thumb_path):
+        return photo_path, thumb_path
+
+    os.makedirs(media_dir, exist_ok=True)
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)
+        # Прозрачность (PNG) кладём на белый фон
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        else:
+            image = image.convert('RGB')
+
+        photo = image.copy()
+        photo.thumbnail((PHOTO_SIDE, PHOTO_SIDE), Image.LANCZOS)
+        _write(photo_path, _encode(photo, PHOTO_MAX_BYTES))
+        thumb = image.copy()
+        thumb.thumbnail((THUMB_SIDE, THUMB_SIDE), Image.LANCZOS)
+        _write(thumb_path, _encode(thumb, None, quality=75))
+    return photo_path, thumb_path
+
+
+# Готовит фото товаров, у которых ещё нет копий (или они пропали с диска)
+async def prepare_photos(media_dir: str = MEDIA_DIR) -> int:
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        logger.warning("Pillow не установлен, фото товаров отправляются без обработки")
+        return 0
+
+    updates = []
+    for product_id, photo, photo_file, thumb_file in await db.get_product_photos():
+        if photo_file and thumb_file and os.path.exists(photo_file) and os.path.exists(thumb_file):
+            continue
+        if not os.path.exists(photo):
+            logger.warning(f"Фото товара {product_id} не найдено: {photo}")
+            continue
+        try:
+            rendered = await asyncio.to_thread(render_photo, photo, media_dir)
+        except Exception as e:
+            logger.error(f"Не удалось обработать фото товара {product_id} ({photo}): {e}")
+            continue
+        updates.append((*rendered, product_id, photo))
+
+    if updates:
+        await db.set_product_photos(updates)
+        logger.info(f"Подготовлено фото товаров: {len(updates)}")
+    return len(updates)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    async def main():
+        await db.init()
+        try:
+            await prepare_photos()
+        finally:
+            await db.close()
+
+    asyncio.run(main())
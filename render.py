@@ -0,0 +1,84 @@
+from collections import OrderedDict
+from typing import Dict, Tuple
+
+from aiohttp import FormData
+from aiogram.types import InlineKeyboardMarkup, TelegramObject
+
+from keyboards import get_product_nav
+from metrics import InstrumentedSession
+
+
+# Описание товара
+def get_product_caption(product):
+    return (
+        f"📛 <b>{product[1]}</b>\n\n"
+        f"📝 <i>{product[2]}</i>\n\n"
+        f"💰 Цена: <b>{product[3]} руб.</b>\n"
+        f"🆔 ID: {product[0]}"
+    )
+
+
+# Готовые подпись и клавиатура каждого товара для текущей версии каталога.
+# При смене версии кэш сбрасывается целиком.
+class ProductRenderCache:
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.hits = 0
+        self.misses = 0
+        self._version = None
+        self._cards: Dict[int, Tuple[tuple, str, InlineKeyboardMarkup]] = {}
+
+    async def get(self, product) -> Tuple[str, InlineKeyboardMarkup]:
+        version = await self.catalog.get_version()
+        if version != self._version:
+            self._cards.clear()
+            self._version = version
+        card = self._cards.get(product[0])
+        if card is None or card[0] != product:
+            self.misses += 1
+            card = self._cards[product[0]] = (product, get_product_caption(product), get_product_nav(product[0], version))
+        else:
+            self.hits += 1
+        return card[1], card[2]
+
+
+# Сессия, которая сериализует каждую клавиатуру в JSON один раз.
+# Кэш по id объекта, поэтому общие клавиатуры (из keyboards и ProductRenderCache) изменять нельзя.
+class RenderSession(InstrumentedSession):
+    def __init__(self, max_markups: int = 1024, **kwargs):
+        super().__init__(**kwargs)
+        self.max_markups = max_markups
+        self.markup_hits = 0
+        self.markup_misses = 0
+        self._markups: "OrderedDict[int, Tuple[TelegramObject, str]]" = OrderedDict()
+
+    def _markup_json(self, markup: TelegramObject, bot) -> str:
+        cached = self._markups.get(id(markup))
+        if cached is not None and cached[0] is markup:
+            self.markup_hits += 1
+            self._markups.move_to_end(id(markup))
+            return cached[1]
+        self.markup_misses += 1
+        # Ссылка на объект в кэше не даёт id достаться другой клавиатуре
+        value = self.prepare_value(markup, bot=bot, files={})
+        self._markups[id(markup)] = (markup, value)
+        if len(self._markups) > self.max_markups:
+            self._markups.popitem(last=False)
+        return value
+
+    def build_form_data(self, bot, method) -> FormData:
+        markup = getattr(method, 'reply_markup', None)
+        if not isinstance(markup, TelegramObject):
+            return super().build_form_data(bot, method)
+
+        form = FormData(quote_fields=False)
+        files = {}
+        for key, value in method.model_dump(warnings=False, exclude={'reply_markup'}).items():
+            value = self.prepare_value(value, bot=bot, files=files)
+            if not value:
+                continue
+            form.add_field(key, value)
+        form.add_field('reply_markup', self._markup_json(markup, bot))
+        for key, value in files.items():
+            form.add_field(key, value.read(bot), filename=value.filename or key)
+        return form
@@ -0,0 +1,46 @@
+import logging
+import re
+from collections import OrderedDict
+from typing import List, Tuple
+
+import db
+
+logger = logging.getLogger(__name__)
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+# Запрос FTS5 из текста пользователя: каждое слово ищется как префикс
+def build_match_query(text: str) -> str:
+    words = WORD_RE.findall(text.lower())[:8]
+    return " ".join(f'"{word}"*' for word in words)
+
+
+# Полнотекстовый поиск по каталогу с LRU-кэшем результатов на версию каталога
+class ProductSearch:
+    def __init__(self, catalog, cache_size: int = 1000, limit: int = 50):
+        self.catalog = catalog
+        self.cache_size = cache_size
+        self.limit = limit
+        self.hits = 0
+        self.misses = 0
+        self._cache: "OrderedDict[Tuple[int, str], List[tuple]]" = OrderedDict()
+
+    async def search(self, text: str) -> List[tuple]:
+        match = build_match_query(text)
+        if not match:
+            return (await self.catalog.get_all())[:self.limit]
+
+        key = (await self.catalog.get_version(), match)
+        results = self._cache.get(key)
+        if results is not None:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return results
+
+        self.misses += 1
+        results = await db.search_products(match, self.limit)
+        self._cache[key] = results
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return results
@@ -0,0 +1,44 @@
+import asyncio
+
+from aiogram.fsm.storage.base import StorageKey
+
+from fsm_storage import SQLiteStorage
+
+KEY = StorageKey(bot_id=1, chat_id=2, user_id=2)
+
+
+def test_processes_see_each_other(sqlite_db):
+    async def scenario():
+        first, second = SQLiteStorage(), SQLiteStorage()
+        await first.start()
+        await second.start()
+        # Второй процесс уже держит ключ в кэше
+        assert await second.get_state(KEY) is None
+
+        await first.set_state(KEY, 'PaymentStates:SELECTING_PAYMENT_METHOD')
+        await first.set_data(KEY, {'order_id': 'abc'})
+        assert await second.get_state(KEY) == 'PaymentStates:SELECTING_PAYMENT_METHOD'
+        assert await second.get_data(KEY) == {'order_id': 'abc'}
+
+        await second.update_data(KEY, {'order_id': 'def'})
+        assert await first.get_data(KEY) == {'order_id': 'def'}
+
+        await first.set_state(KEY, None)
+        await first.set_data(KEY, {})
+        assert await second.get_state(KEY) is None
+        assert await second.get_data(KEY) == {}
+
+        await first.close()
+        await second.close()
+    asyncio.run(scenario())
+
+
+def test_cached_record_reused(sqlite_db):
+    async def scenario():
+        storage = SQLiteStorage()
+        await storage.set_data(KEY, {'order_id': 'abc'})
+        record = storage._cache[storage._key(KEY)]
+        assert await storage.get_data(KEY) == {'order_id': 'abc'}
+        assert storage._cache[storage._key(KEY)] is record
+        await storage.close()
+    asyncio.run(scenario())
@@ -0,0 +1,37 @@
+import asyncio
+
+from importer import iter_rows
+
+DATA = 'name,description,price\n"A","line1\nline2",100\nB,"say ""hi""\r\nok",5\r\nC,plain,7'.encode()
+
+
+def read_rows(parts) -> list:
+    async def chunks():
+        for part in parts:
+            yield part
+
+    async def scenario():
+        rows = []
+        async for batch in iter_rows(chunks()):
+            rows.extend(batch)
+        return rows
+    return asyncio.run(scenario())
+
+
+def test_quoted_newline_across_chunks():
+    expected = [
+        ['name', 'description', 'price'],
+        ['A', 'line1\nline2', '100'],
+        ['B', 'say "hi"\r\nok', '5'],
+        ['C', 'plain', '7'],
+    ]
+    assert read_rows([DATA]) == expected
+    for split in range(1, len(DATA)):
+        assert read_rows([DATA[:split], DATA[split:]]) == expected, split
+
+
+def test_unclosed_quote_does_not_buffer_whole_file(monkeypatch):
+    import importer
+    monkeypatch.setattr(importer, 'MAX_RECORD_LENGTH', 100)
+    rows = read_rows([b'"broken\n'] + [b'code\n'] * 50)
+    assert len(rows) > 1
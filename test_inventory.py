@@ -0,0 +1,81 @@
+import asyncio
+
+import db
+from inventory import Inventory
+
+PRODUCT_ID = 999
+
+
+async def add_codes(count: int):
+    await db.insert_codes([(PRODUCT_ID, f"C{i}") for i in range(count)])
+
+
+async def claim_all(inventory: Inventory) -> list:
+    codes = []
+    while True:
+        code = await inventory.claim(PRODUCT_ID, 2)
+        if code is None:
+            return codes
+        codes.append(code)
+
+
+async def age_reservations():
+    await db.db.execute("UPDATE products_code SET reserved_at = 0 WHERE reserved_by IS NOT NULL")
+
+
+def test_order_marks_code_claimed(sqlite_db):
+    async def scenario():
+        await add_codes(3)
+        crashed = Inventory(batch_size=3)
+        rowid, sold = await crashed.reserve(PRODUCT_ID)
+        await db.add_order(1, PRODUCT_ID, 'o1', 'paid', 100, sold, 'online', crashed.claim_mark(rowid, 1))
+        await age_reservations()
+
+        inventory = Inventory()
+        await inventory.start()
+        codes = await claim_all(inventory)
+        await inventory.stop()
+        assert sold not in codes
+        assert len(codes) == 2
+    asyncio.run(scenario())
+
+
+def test_recorded_code_not_reclaimed(sqlite_db):
+    async def scenario():
+        await add_codes(3)
+        # Процесс выдал код и записал заказ, но упал до фоновой отметки о выдаче
+        crashed = Inventory(batch_size=3)
+        sold = await crashed.claim(PRODUCT_ID, 1)
+        await db.add_order(1, PRODUCT_ID, 'o1', 'paid', 100, sold, 'online')
+        await age_reservations()
+
+        inventory = Inventory()
+        await inventory.start()
+        codes = await claim_all(inventory)
+        await inventory.stop()
+        assert sold not in codes
+        assert len(codes) == 2
+    asyncio.run(scenario())
+
+
+def test_expired_reservations_released(sqlite_db):
+    async def scenario():
+        await add_codes(9)
+        inventory = Inventory(batch_size=5, lease=2)
+        await inventory.start()
+        assert inventory.stock(PRODUCT_ID) == 9
+        await inventory.claim(PRODUCT_ID, 1)
+        # Оставшиеся в памяти коды зарезервированы дольше половины срока
+        reserved = inventory._reserved[PRODUCT_ID]
+        for i, (rowid, code, reserved_at) in enumerate(reserved):
+            reserved[i] = (rowid, code, reserved_at - 10)
+        await inventory.claim(PRODUCT_ID, 2)
+        assert inventory.stock(PRODUCT_ID) == 7
+        await inventory.stop()
+
+        rows = await db.db.fetchall(
+            "SELECT reserved_by IS NOT NULL, claimed_by IS NOT NULL FROM products_code WHERE id_product = ?",
+            (PRODUCT_ID,)
+        )
+        assert sorted(rows) == [(0, 0)] * 7 + [(1, 1)] * 2
+    asyncio.run(scenario())
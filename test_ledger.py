@@ -0,0 +1,35 @@
+import asyncio
+
+import pytest
+
+import db
+
+
+def test_order_id_unique(sqlite_db):
+    async def scenario():
+        await db.add_order(1, 1, 'charge-1', 'paid', 100, None, 'online')
+        with pytest.raises(db.sqlite3.IntegrityError):
+            await db.add_order(1, 1, 'charge-1', 'paid', 100, None, 'online')
+    asyncio.run(scenario())
+
+
+def test_payment_recovery_started_once(sqlite_db):
+    async def scenario():
+        assert await db.add_payment('charge-1', 1, 1, 100)
+        assert not await db.add_payment('charge-1', 1, 1, 100)
+        started = await asyncio.gather(*(db.start_payment_recovery('charge-1') for _ in range(3)))
+        assert sorted(started) == [False, False, True]
+    asyncio.run(scenario())
+
+
+def test_duplicate_order_keeps_code_unclaimed(sqlite_db):
+    async def scenario():
+        await db.insert_codes([(999, 'A'), (999, 'B')])
+        (first, _), (second, _) = await db.reserve_codes(999, 'owner', 2, 0)
+        await db.add_order(1, 999, 'charge-1', 'paid', 100, 'A', 'online', (1, 0, first, 'owner'))
+        with pytest.raises(db.sqlite3.IntegrityError):
+            await db.add_order(1, 999, 'charge-1', 'paid', 100, 'B', 'online', (1, 0, second, 'owner'))
+        assert await db.get_order_code('charge-1') == 'A'
+        claimed = await db.db.fetchall("SELECT code FROM products_code WHERE claimed_by IS NOT NULL AND id_product = 999")
+        assert claimed == [('A',)]
+    asyncio.run(scenario())
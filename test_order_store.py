@@ -0,0 +1,81 @@
+import asyncio
+import time
+
+import pytest
+
+from order_store import MemoryOrderStore, RedisOrderStore, SQLiteOrderStore
+
+
+def make_memory():
+    return MemoryOrderStore(ttl=60, max_size=100)
+
+
+def make_sqlite():
+    return SQLiteOrderStore(ttl=60, max_size=100)
+
+
+def make_redis():
+    fakeredis = pytest.importorskip('fakeredis')
+    return RedisOrderStore('', ttl=60, max_size=100, client=fakeredis.FakeAsyncRedis(decode_responses=True))
+
+
+@pytest.fixture(params=['memory', 'sqlite', 'redis'])
+def make_store(request):
+    if request.param == 'sqlite':
+        request.getfixturevalue('sqlite_db')
+    return {'memory': make_memory, 'sqlite': make_sqlite, 'redis': make_redis}[request.param]
+
+
+def test_put_get_delete(make_store):
+    async def scenario():
+        store = make_store()
+        order_id = await store.create(1, {'product_id': 2, 'price': 100})
+        assert (await store.get(order_id))['product_id'] == 2
+        await store.delete(order_id)
+        assert await store.get(order_id) is None
+        await store.close()
+    asyncio.run(scenario())
+
+
+def test_take_returns_order_once(make_store):
+    async def scenario():
+        store = make_store()
+        order_id = await store.create(1, {'product_id': 2, 'price': 100})
+        taken = await asyncio.gather(*(store.take(order_id) for _ in range(5)))
+        assert [order for order in taken if order] == [{'product_id': 2, 'price': 100, 'order_id': order_id, 'user_id': 1}]
+        assert await store.get(order_id) is None
+        assert await store.take('missing') is None
+        await store.close()
+    asyncio.run(scenario())
+
+
+def test_memory_take_expired():
+    async def scenario():
+        store = MemoryOrderStore(ttl=60, max_size=100)
+        await store.put('old', {'user_id': 1})
+        store._orders['old'] = (time.time() - 1, {'user_id': 1})
+        assert await store.take('old') is None
+        assert len(store) == 0
+    asyncio.run(scenario())
+
+
+def test_sqlite_take_expired(sqlite_db):
+    async def scenario():
+        store = SQLiteOrderStore(ttl=-1, max_size=100)
+        await store.put('old', {'user_id': 1})
+        assert await store.take('old') is None
+    asyncio.run(scenario())
+
+
+def test_redis_evicts_least_recently_used():
+    async def scenario():
+        store = make_redis()
+        store.max_size = 2
+        for order_id in ('a', 'b'):
+            await store.put(order_id, {'user_id': 1})
+        await store.get('a')
+        await store.put('c', {'user_id': 1})
+        assert await store.get('b') is None
+        assert await store.get('a') is not None
+        await store.close()
+    asyncio.run(scenario())
@@ -0,0 +1,97 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import CallbackQuery, TelegramObject
+
+from background import spawn
+from metrics import metrics
+from notifier import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]]
+
+
+# Лимит из конфига вида "запросов_в_секунду:запас", например "3:6"
+def parse_limit(value: str) -> Tuple[float, float]:
+    rate, _, capacity = value.partition(':')
+    rate = float(rate)
+    return rate, float(capacity) if capacity else max(1.0, rate)
+
+
+# Ограничение частоты апдейтов от одного пользователя.
+# Хендлер выбирает лимит флагом throttle (например flags={"throttle": "nav"}).
+# Лишние сообщения отбрасываются, а лишние нажатия кнопок склеиваются:
+# когда ведро наполнится, обрабатывается только последнее нажатие в чате.
+# Вёдра хранятся в LRU не больше max_size штук и удаляются после ttl секунд без апдейтов.
+class ThrottlingMiddleware(BaseMiddleware):
+    def __init__(self, limits: Dict[str, Tuple[float, float]], max_size: int = 100000, ttl: float = 600.0):
+        self.limits = limits
+        self.max_size = max_size
+        self.ttl = ttl
+        self.dropped = 0
+        self.coalesced = 0
+        self._buckets: "OrderedDict[Tuple[int, str], TokenBucket]" = OrderedDict()
+        self._pending: Dict[Tuple[int, str], Tuple[Handler, CallbackQuery, Dict[str, Any]]] = {}
+
+    def _bucket(self, user_id: int, name: str) -> TokenBucket:
+        key = (user_id, name)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(*self.limits[name])
+        else:
+            self._buckets.move_to_end(key)
+
+        now = time.monotonic()
+        while len(self._buckets) > 1:
+            old_key, old_bucket = next(iter(self._buckets.items()))
+            if len(self._buckets) <= self.max_size and now - old_bucket.updated_at < self.ttl:
+                break
+            del self._buckets[old_key]
+        return bucket
+
+    async def __call__(self, handler: Handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        name = get_flag(data, 'throttle')
+        user = data.get('event_from_user')
+        if name not in self.limits or user is None:
+            return await handler(event, data)
+
+        bucket = self._bucket(user.id, name)
+        if isinstance(event, CallbackQuery) and event.message:
+            key = (event.message.chat.id, name)
+            # Пока ждёт отложенное нажатие, новые встают на его место, чтобы не обогнать его
+            if key not in self._pending and bucket.try_acquire():
+                return await handler(event, data)
+            previous = self._pending.get(key)
+            self._pending[key] = (handler, event, data)
+            if previous is None:
+                spawn(self._process_later(key, bucket), name="throttle_later")
+            else:
+                self.coalesced += 1
+                metrics.inc('throttle_coalesced_total', handler=name)
+                await previous[1].answer()
+            return None
+
+        if bucket.try_acquire():
+            return await handler(event, data)
+        self.dropped += 1
+        metrics.inc('throttle_dropped_total', handler=name)
+        logger.debug(f"Апдейт от {user.id} отброшен лимитом {name}")
+        if isinstance(event, CallbackQuery):
+            await event.answer()
+        return None
+
+    async def _process_later(self, key: Tuple[int, str], bucket: TokenBucket):
+        try:
+            await bucket.acquire()
+        finally:
+            # Даже если задача прервана, следующие нажатия в этом чате не должны ждать её вечно
+            handler, event, data = self._pending.pop(key)
+        try:
+            await handler(event, data)
+        except Exception as e:
+            logger.error(f"Ошибка при обработке отложенного нажатия {event.data}: {e}")
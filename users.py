@@ -0,0 +1,48 @@
+import asyncio
+import logging
+from typing import Dict, Optional, Set, Tuple
+
+import db
+from background import PeriodicFlusher, spawn
+
+logger = logging.getLogger(__name__)
+
+
+# Регистрация пользователей с отложенной записью: новые пользователи копятся в буфере
+# и записываются одной транзакцией каждые flush_size записей или flush_interval секунд
+class UserRegistry:
+    def __init__(self, flush_size: int = 200, flush_interval: float = 1.0):
+        self.flush_size = flush_size
+        self._known: Set[int] = set()
+        self._buffer: Dict[int, Tuple[str, str]] = {}
+        self._flusher = PeriodicFlusher(self.flush, flush_interval, "users")
+        self._flush_lock = asyncio.Lock()
+
+    async def start(self):
+        self._known = set(await db.get_user_ids())
+        logger.info(f"Известных пользователей: {len(self._known)}")
+        self._flusher.start()
+
+    async def stop(self):
+        await self._flusher.stop()
+
+    # Возвращает True, если пользователь новый
+    def register(self, tg_id: int, username: Optional[str], full_name: str) -> bool:
+        if tg_id in self._known:
+            return False
+        self._known.add(tg_id)
+        self._buffer[tg_id] = (username or '', full_name)
+        if len(self._buffer) >= self.flush_size:
+            spawn(self.flush(), name="users_flush")
+        return True
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._buffer:
+                return
+            buffer, self._buffer = self._buffer, {}
+            try:
+                await db.upsert_users([(tg_id, *names) for tg_id, names in buffer.items()])
+            except Exception as e:
+                logger.error(f"Не удалось записать пользователей: {e}")
+                self._buffer = {**buffer, **self._buffer}
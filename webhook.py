@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import os
+import signal
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+from photos import MEDIA_DIR
+
+logger = logging.getLogger(__name__)
+
+
+# Обработчик вебхука, который умеет дождаться уже принятых апдейтов
+class DrainingRequestHandler(SimpleRequestHandler):
+    async def drain(self, timeout: float):
+        tasks = set(self._background_feed_update_tasks)
+        if not tasks:
+            return
+        logger.info(f"Ожидание обработки {len(tasks)} апдейтов перед остановкой")
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        if pending:
+            logger.warning(f"Не дождались {len(pending)} апдейтов, они будут прерваны")
+
+
+async def handle_health(request: web.Request) -> web.Response:
+    return web.Response(text="ok")
+
+
+async def handle_ready(request: web.Request) -> web.Response:
+    if request.app['ready']:
+        return web.Response(text="ready")
+    return web.Response(status=503, text="not ready")
+
+
+# Приложение aiohttp: вебхук, /healthz и /readyz; /media только при media=True.
+# /metrics сюда не вешаем: этот порт открыт наружу, метрики отдаёт start_metrics_server
+def create_app(dp: Dispatcher, bot: Bot, path: str = '/webhook', secret: str = '',
+               drain_timeout: float = 30.0, media: bool = False) -> web.Application:
+    app = web.Application()
+    app['ready'] = False
+    app['drain_timeout'] = drain_timeout
+    handler = DrainingRequestHandler(dispatcher=dp, bot=bot, secret_token=secret or None)
+    app['webhook_handler'] = handler
+
+    async def on_startup(app: web.Application):
+        app['ready'] = True
+
+    # Сначала перестаём принимать трафик и дожидаемся апдейтов, потом закрываем бота
+    async def on_shutdown(app: web.Application):
+        app['ready'] = False
+        await handler.drain(drain_timeout)
+
+    app.on_shutdown.append(on_shutdown)
+    handler.register(app, path=path)
+    setup_application(app, dp, bot=bot)
+    app.on_startup.append(on_startup)
+
+    app.router.add_get('/healthz', handle_health)
+    app.router.add_get('/readyz', handle_ready)
+    # Подготовленные фото и миниатюры, нужны Telegram только для MEDIA_URL в inline-поиске
+    if media:
+        os.makedirs(MEDIA_DIR, exist_ok=True)
+        app.router.add_static('/media', MEDIA_DIR)
+    return app
+
+
+# При остановке /readyz сразу отвечает 503, но вебхук ещё WEBHOOK_GRACE секунд принимает апдейты,
+# пока балансировщик не уберёт инстанс; затем дожидаемся принятых апдейтов и закрываем сервер
+async def run_webhook(dp: Dispatcher, bot: Bot, config: dict):
+    path = config['WEBHOOK_PATH']
+    secret = config['WEBHOOK_SECRET']
+    grace = float(config['WEBHOOK_GRACE'])
+    app = create_app(dp, bot, path=path, secret=secret, media=bool(config['MEDIA_URL']))
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, config['WEBHOOK_HOST'], int(config['WEBHOOK_PORT']), reuse_port=True)
+    await site.start()
+    logger.info(f"Вебхук слушает {config['WEBHOOK_HOST']}:{config['WEBHOOK_PORT']}{path}")
+
+    if config['WEBHOOK_URL']:
+        await bot.set_webhook(config['WEBHOOK_URL'].rstrip('/') + path, secret_token=secret or None)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        logger.info(f"Остановка вебхука, приём апдейтов ещё {grace:g} с")
+        app['ready'] = False
+        await asyncio.sleep(grace)
+        await app['webhook_handler'].drain(app['drain_timeout'])
+        await runner.cleanup()